@@ -0,0 +1,224 @@
+import math
+import threading
+import time
+import numpy as np
+
+from constants import *
+from media import seq_newer, signed_delay
+from audio_codec import decode_audio
+
+BLOCK_MS = BLOCK_SIZE / SAMPLE_RATE * 1000
+MIN_DEPTH = 1 # blocks buffered before playout starts, at least
+MAX_DEPTH = 8
+DRIFT_SLACK = 2 # blocks above the target depth tolerated before dropping one
+FEC_HOLD = 2.0 # seconds after the last parity datagram before the buffer stops allowing for it
+PLC_FADE = 0.5 # each concealed block is this much quieter than the one before
+MAX_PLC_BLOCKS = 3 # after this many lost blocks in a row play silence
+SILENCE = np.zeros(BLOCK_SIZE, dtype=np.int16)
+
+# voice activity detection
+VAD_FRAME = 256 # samples per analysis frame, 8 frames per block
+SPEECH_MARGIN = 9 # dB above the noise floor that is speech outright
+VOICED_MARGIN = 4 # dB above the noise floor that is speech when the frame is also voiced
+VOICED_ZCR = 0.1 # zero crossings per sample below which a frame is voiced rather than hiss
+QUIETEST_SPEECH = 60 # level (-dBov) of the quietest frame that can be speech
+SPEECH_FRAMES = 2 # speech frames that make a block speech
+HANGOVER_BLOCKS = 5 # blocks still sent after the last speech, so word endings are not cut
+NOISE_RISE = 0.05 # how fast the noise floor follows louder frames that are not speech
+
+rng = np.random.default_rng()
+
+
+def block_level(samples: np.ndarray) -> int:
+    # -dBov of the block's RMS, 0 for a full-scale square wave, SILENT_LEVEL for digital silence
+    rms = np.sqrt(np.mean(samples.astype(np.float32) ** 2))
+    if rms < 1:
+        return SILENT_LEVEL
+    return int(min(SILENT_LEVEL, max(0, round(-20 * math.log10(rms / 32768)))))
+
+
+def comfort_noise(level: int) -> np.ndarray:
+    # white noise standing in for a silent sender's background, at the level it reported
+    if level >= SILENT_LEVEL:
+        return SILENCE
+    rms = 32768 * 10 ** (-level / 20)
+    return np.clip(rng.normal(0, rms, BLOCK_SIZE), -32768, 32767).astype(np.int16)
+
+
+class VoiceDetector:
+    # energy and zero crossing rate of every frame of a block, compared with a noise
+    # floor learnt from the frames that are not speech
+    def __init__(self):
+        self.noise = None # noise floor in dBov
+        self.hangover = 0
+
+    def noise_level(self) -> int:
+        return SILENT_LEVEL if self.noise is None else int(min(SILENT_LEVEL, max(0, round(-self.noise))))
+
+    def is_speech(self, samples: np.ndarray) -> bool:
+        frames = samples[:len(samples) // VAD_FRAME * VAD_FRAME].astype(np.float32).reshape(-1, VAD_FRAME)
+        energy = 10 * np.log10(np.mean(frames ** 2, axis=1) / 32768 ** 2 + 1e-13) # dBov
+        zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+        if self.noise is None:
+            self.noise = float(energy.min())
+
+        above = energy - self.noise
+        speech = (energy > -QUIETEST_SPEECH) & ((above > SPEECH_MARGIN) | ((above > VOICED_MARGIN) & (zcr < VOICED_ZCR)))
+        quiet = energy[~speech]
+        if quiet.size:
+            # the floor drops at once to a quieter frame and creeps up towards louder ones
+            if quiet.min() < self.noise:
+                self.noise = float(quiet.min())
+            else:
+                self.noise += NOISE_RISE * (float(quiet.mean()) - self.noise)
+
+        if np.count_nonzero(speech) >= SPEECH_FRAMES:
+            self.hangover = HANGOVER_BLOCKS
+            return True
+        if self.hangover:
+            self.hangover -= 1
+            return True
+        return False
+
+
+class JitterBuffer:
+    # orders one sender's audio blocks by sequence number and hands them out
+    # one at a time, at the pace of the output device
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {} # seq -> int16 samples
+        self.next_seq = None
+        self.playing = False
+        self.jitter = 0.0 # smoothed interarrival jitter in ms
+        self.last_transit = None
+        self.last_block = SILENCE
+        self.lost_run = 0
+        self.silent = False # the sender sent comfort noise and no speech since
+        self.noise_level = SILENT_LEVEL # of the sender's background, from its comfort noise
+        self.fec_depth = 0 # blocks per parity group, buffered so a block rebuilt from parity is still in time
+        self.fec_seen = float('-inf') # last time parity arrived
+
+    def target_depth(self) -> int:
+        fec_depth = self.fec_depth if time.monotonic() - self.fec_seen < FEC_HOLD else 0
+        return min(MAX_DEPTH, max(MIN_DEPTH, fec_depth, math.ceil(3 * self.jitter / BLOCK_MS) + 1))
+
+    def protect(self, blocks: int):
+        # parity over this many blocks arrived: the first of them can only be rebuilt after the last
+        self.fec_depth, self.fec_seen = blocks, time.monotonic()
+
+    def put(self, packet: MediaPacket, rebuilt: bool = False):
+        # interarrival jitter as in RFC 3550, independent of the sender's clock offset;
+        # a block rebuilt from parity arrives as late as its group's last and says nothing about it
+        if not rebuilt:
+            transit = signed_delay(timestamp_ms(), packet.timestamp)
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+
+        if packet.layer == COMFORT_NOISE:
+            # the sender went silent: blocks still buffered play out, then comfort noise
+            # until it talks again, without counting the blocks it did not send as lost
+            with self.lock:
+                self.silent = True
+                self.noise_level = packet.level
+            return
+
+        block = SILENCE # microphone disabled, or a payload that does not decode
+        if packet.data:
+            decoded = decode_audio(packet.layer, packet.data)
+            if decoded is not None:
+                block = decoded
+        with self.lock:
+            if self.silent:
+                # a new talkspurt: buffer it up again, which also adapts the playout delay
+                self.silent = False
+                self.playing = False
+            jumped = self.next_seq is not None and seq_newer(packet.seq, self.next_seq) \
+                and (packet.seq - self.next_seq) & 0xFFFFFFFF > 4 * MAX_DEPTH
+            if self.next_seq is None or jumped:
+                # first block, or the sender jumped ahead: start over from here
+                self.blocks.clear()
+                self.next_seq = packet.seq
+                self.playing = False
+            elif not seq_newer(packet.seq, (self.next_seq - 1) & 0xFFFFFFFF):
+                return # too late, its slot was already played or concealed
+            self.blocks[packet.seq] = block
+
+            # the sender's clock runs faster than our device: skip the oldest block
+            while len(self.blocks) > self.target_depth() + DRIFT_SLACK:
+                self.blocks.pop(self.next_seq, None)
+                self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+
+    def get(self) -> np.ndarray:
+        with self.lock:
+            if not self.playing:
+                if self.next_seq is None or len(self.blocks) < self.target_depth():
+                    return comfort_noise(self.noise_level)
+                self.playing = True
+                # start from the oldest buffered block rather than concealing a gap
+                self.next_seq = min(self.blocks, key=lambda seq: (seq - self.next_seq) & 0xFFFFFFFF)
+            if self.silent and not self.blocks:
+                return comfort_noise(self.noise_level) # nothing is missing, the sender is just quiet
+
+            block = self.blocks.pop(self.next_seq, None)
+            self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+            if block is not None:
+                self.lost_run = 0
+                self.last_block = block
+                return block
+
+            # packet loss concealment: fade out the last block we played
+            self.lost_run += 1
+            if not self.blocks and self.lost_run > self.target_depth():
+                self.playing = False # ran dry, rebuffer before playing again
+            if self.lost_run > MAX_PLC_BLOCKS:
+                return SILENCE
+            return (self.last_block * PLC_FADE ** self.lost_run).astype(np.int16)
+
+
+def mix_blocks(blocks: np.ndarray, gains: np.ndarray) -> np.ndarray:
+    # weighted sum of int16 blocks (one per row), clipped back to int16
+    mixed = gains.astype(np.float32) @ blocks.astype(np.float32)
+    return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+
+class Mixer:
+    # sums every remote client's jitter buffer into one output block
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {} # client name -> JitterBuffer
+        self.gains = {} # client name -> volume, 1.0 is unchanged
+        self.volume = 1.0
+
+    def add(self, name: str, jitter_buffer: JitterBuffer, gain: float = 1.0):
+        with self.lock:
+            self.sources[name] = jitter_buffer
+            self.gains[name] = gain
+
+    def remove(self, name: str):
+        with self.lock:
+            self.sources.pop(name, None)
+            self.gains.pop(name, None)
+
+    def set_gain(self, name: str, gain: float):
+        with self.lock:
+            if name in self.gains:
+                self.gains[name] = gain
+
+    def mix(self) -> np.ndarray:
+        with self.lock:
+            names = tuple(self.sources)
+            sources = [self.sources[name] for name in names]
+            gains = np.array([self.gains[name] for name in names], dtype=np.float32) * self.volume
+        if not sources:
+            return SILENCE
+        # every buffer advances one block per device tick, even when it plays silence
+        blocks = np.stack([jitter_buffer.get() for jitter_buffer in sources])
+        return mix_blocks(blocks, gains)
+
+
+def mix_n_minus_one(blocks: list) -> np.ndarray:
+    # row i of the result is the sum of every block except blocks[i]
+    blocks = np.stack(blocks).astype(np.int32)
+    mixes = blocks.sum(axis=0) - blocks
+    return np.clip(mixes, -32768, 32767).astype(np.int16)
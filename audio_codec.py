@@ -0,0 +1,129 @@
+import struct
+import warnings
+import numpy as np
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop # C IMA ADPCM: standard library up to Python 3.12, the audioop-lts package after
+    except ImportError:
+        audioop = None
+
+from constants import *
+
+# one codec for every stream, None negotiates the smallest one everyone in the room decodes
+AUDIO_CODEC = None
+# smallest output first, the order codecs are negotiated in
+PREFERENCE = ('adpcm', 'ulaw', 'pcm')
+MU = 255
+ADPCM_STATE = struct.Struct('>hB') # predicted sample and step index the block starts from
+DECODE_ERRORS = (ValueError, struct.error) + ((audioop.error,) if audioop else ())
+
+# Every codec turns one block of 16-bit mono PCM into one datagram payload and back,
+# and every payload decodes on its own, so a lost datagram never corrupts the next.
+# Encoders may keep state between blocks, so each stream gets its own instance.
+
+
+def ulaw_tables() -> tuple[np.ndarray, np.ndarray]:
+    # mu-law companding as lookup tables: sign bit and 7-bit log magnitude
+    levels = np.arange(128, dtype=np.float64) / 127
+    magnitudes = np.round(np.expm1(levels * np.log1p(MU)) / MU * 32767)
+    decode = np.concatenate([magnitudes, -magnitudes]).astype(np.int16)
+
+    samples = np.abs(np.arange(-32768, 32768, dtype=np.float64)) / 32768
+    codes = np.round(np.log1p(MU * samples) / np.log1p(MU) * 127).astype(np.uint8)
+    encode = np.where(np.arange(-32768, 32768) < 0, codes | 0x80, codes).astype(np.uint8)
+    return encode, decode
+
+
+class PCMCodec:
+    name = 'pcm'
+
+    def encode(self, block) -> bytes:
+        return bytes(block)
+
+    def decode(self, data) -> np.ndarray:
+        return np.frombuffer(data, dtype=np.int16).copy()
+
+
+class MuLawCodec:
+    name = 'ulaw'
+    encode_table, decode_table = ulaw_tables()
+
+    def encode(self, block) -> bytes:
+        samples = np.frombuffer(block, dtype=np.int16)
+        return self.encode_table[samples.astype(np.int32) + 32768].tobytes()
+
+    def decode(self, data) -> np.ndarray:
+        return self.decode_table[np.frombuffer(data, dtype=np.uint8)]
+
+
+class ADPCMCodec:
+    name = 'adpcm'
+
+    def __init__(self):
+        if audioop is None:
+            raise ImportError("audioop is not available")
+        self.state = None # carried over so the step size does not restart every block
+
+    def encode(self, block) -> bytes:
+        predicted, index = self.state or (0, 0)
+        data, self.state = audioop.lin2adpcm(bytes(block), 2, self.state)
+        return ADPCM_STATE.pack(predicted, index) + data
+
+    def decode(self, data) -> np.ndarray:
+        if len(data) < ADPCM_STATE.size:
+            return None
+        state = ADPCM_STATE.unpack_from(data)
+        samples, _ = audioop.adpcm2lin(bytes(data[ADPCM_STATE.size:]), 2, state)
+        return np.frombuffer(samples, dtype=np.int16).copy()
+
+
+CODECS = {codec.name: codec for codec in (PCMCodec, MuLawCodec, ADPCMCodec)}
+
+
+def get_audio_codec(name: str):
+    # a fresh codec, PCM if this one cannot run here
+    try:
+        return CODECS[name]()
+    except (KeyError, ImportError):
+        print(f"[ERROR] Audio codec {name} not available, using {PCMCodec.name}")
+        return PCMCodec()
+
+
+def available_codecs() -> tuple[str]:
+    names = []
+    for name in PREFERENCE:
+        try:
+            CODECS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return tuple(names)
+
+
+def choose_codec(*supported: tuple[str]) -> str:
+    # the smallest codec in every list, PCM is always understood
+    if AUDIO_CODEC is not None:
+        return AUDIO_CODEC
+    for name in PREFERENCE:
+        if all(name in codecs for codecs in supported):
+            return name
+    return PCMCodec.name
+
+
+decoders = {AUDIO_CODECS.index(name): CODECS[name]() for name in available_codecs()}
+
+
+def decode_audio(codec_id: int, data) -> np.ndarray:
+    # samples of one audio payload, None for a codec this side cannot decode
+    decoder = decoders.get(codec_id, None)
+    if decoder is None:
+        return None
+    try:
+        samples = decoder.decode(data)
+    except DECODE_ERRORS:
+        return None
+    if samples is None or len(samples) != BLOCK_SIZE:
+        return None # blocks are mixed sample by sample, a short one would not line up
+    return samples
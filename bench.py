@@ -0,0 +1,376 @@
+import argparse
+import array
+import json
+import os
+import pickle
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from constants import *
+from audio_codec import get_audio_codec
+from media import VIDEO_FRAGMENT
+
+HOST = '127.0.0.1'
+CLIENT_COUNTS = (2, 4, 8, 16)
+DURATION = 10.0 # seconds of streaming per step
+WARMUP = 0.5 # seconds between the last ADD and the first frame, so routes are in place
+DRAIN = 0.5 # seconds receivers keep counting after the senders stop
+VIDEO_FPS = 15
+FRAME_BYTES = 6000 # synthetic JPEG size, a 240p frame at moderate quality
+RECV_BUFFER = 4 * 1024 * 1024
+SERVER_START_TIMEOUT = 5.0
+RELAY_PORT_STEP = 100 # port offset between the relays of a cascade, clear of their worker ports
+SEND_TIME = struct.Struct('>d') # perf_counter at send, right after the header of every datagram
+SPEECH_LEVEL = 20 # audio level (-dBov) in the blocks of fake speakers, everyone else is silent
+SPEAKER_WARMUP = 1.0 # seconds speakers talk before the first frame, so the relay has ranked them
+
+# Every fake client lives in this one process, so perf_counter stamped by the
+# sender and read by the receiver is the same clock: latency is exact relay latency.
+
+
+def fake_jpeg(size: int) -> bytes:
+    # SOI, filler, EOI: enough to look like a frame, nothing here decodes it
+    return b'\xff\xd8' + os.urandom(max(0, size - 4)) + b'\xff\xd9'
+
+
+def fake_audio(codec: str) -> bytes:
+    # one block of 16-bit mono silence, encoded as a real client would
+    return get_audio_codec(codec).encode(bytes(BLOCK_SIZE * 2))
+
+
+class FakeClient:
+    def __init__(self, name: str, host: str, room: str = DEFAULT_ROOM, port: int = MAIN_PORT, audio_codec: str = AUDIO_CODECS[0]):
+        self.name = name
+        self.room = room
+        self.audio_codec = AUDIO_CODECS.index(audio_codec) # sent in the layer byte of every block
+        self.main_socket = socket.create_connection((host, port))
+        self.main_socket.send_bytes(f"{name} {room} {audio_codec}".encode())
+        status = self.main_socket.recv_bytes().decode()
+        if status != OK:
+            raise ConnectionError(f"{name}: {status}")
+        self.id = int(self.main_socket.recv_bytes().decode())
+        # a mixing relay appends the audio codecs it encodes with
+        video_port, audio_port, file_port, *relay_codecs = self.main_socket.recv_bytes().decode().split()
+        video_port, audio_port = int(video_port), int(audio_port)
+        self.main_socket.setblocking(False)
+
+        self.addrs = {VIDEO: (host, video_port), AUDIO: (host, audio_port)}
+        self.media_sockets = {}
+        for media, addr in self.addrs.items():
+            conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+            conn.setblocking(False)
+            conn.sendto(MediaPacket(ADD, media, self.id).pack(), addr)
+            self.media_sockets[media] = conn
+        self.seq = {VIDEO: 0, AUDIO: 0}
+        self.level = SILENT_LEVEL # level claimed by audio blocks
+
+    def send(self, media: str, data: bytes) -> int:
+        # one frame or block, fragmented like the real client does; returns datagrams sent
+        chunk = (VIDEO_FRAGMENT if media == VIDEO else MEDIA_SIZE[media]) - MEDIA_HEADER.size
+        count = max(1, -(-len(data) // chunk))
+        timestamp = timestamp_ms()
+        conn, addr = self.media_sockets[media], self.addrs[media]
+        for frag in range(count):
+            packet = MediaPacket(POST, media, self.id, self.seq[media], timestamp,
+                                 data[frag * chunk:(frag + 1) * chunk], self.audio_codec if media == AUDIO else 0, frag, count,
+                                 self.level)
+            datagram = bytearray(packet.pack())
+            SEND_TIME.pack_into(datagram, MEDIA_HEADER.size, time.perf_counter())
+            try:
+                conn.sendto(datagram, addr)
+            except BlockingIOError:
+                pass # counted as lost by the receivers, like the network would
+        self.seq[media] = (self.seq[media] + 1) & 0xFFFFFFFF
+        return count
+
+    def close(self):
+        try:
+            self.main_socket.setblocking(True)
+            self.main_socket.send_bytes(pickle.dumps(Message(self.name, DISCONNECT)))
+        except OSError:
+            pass
+        self.main_socket.close()
+        for conn in self.media_sockets.values():
+            conn.close()
+
+
+class Receiver(threading.Thread):
+    # one thread reads every fake client's sockets, keeping the per-datagram work tiny
+    def __init__(self, fake_clients: list, keep_alive_ids: set):
+        super().__init__(daemon=True)
+        self.keep_alive_ids = keep_alive_ids # senders whose video the relay only keeps alive, counted apart
+        self.sel = selectors.DefaultSelector()
+        for fake in fake_clients:
+            self.sel.register(fake.main_socket, selectors.EVENT_READ, (fake, TEXT))
+            for media, conn in fake.media_sockets.items():
+                self.sel.register(conn, selectors.EVENT_READ, (fake, media))
+        self.received = {VIDEO: 0, AUDIO: 0}
+        self.keep_alive = 0
+        self.bytes = {VIDEO: 0, AUDIO: 0}
+        self.latencies = {VIDEO: array.array('d'), AUDIO: array.array('d')} # ms
+        self.running = True
+
+    def run(self):
+        buf = bytearray(max(MEDIA_SIZE.values()))
+        while self.running:
+            for key, _ in self.sel.select(0.1):
+                fake, media = key.data
+                conn = key.fileobj
+                while True:
+                    try:
+                        if media == TEXT:
+                            if not conn.recv(65536): # control messages are only drained
+                                self.sel.unregister(conn)
+                            break
+                        nbytes = conn.recv_into(buf)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        break
+                    now = time.perf_counter()
+                    if nbytes < MEDIA_HEADER.size + SEND_TIME.size:
+                        continue
+                    self.bytes[media] += nbytes # all relay egress, keep-alive frames included
+                    if self.keep_alive_ids and media == VIDEO and MEDIA_HEADER.unpack_from(buf)[2] in self.keep_alive_ids:
+                        self.keep_alive += 1
+                        continue
+                    self.received[media] += 1
+                    self.latencies[media].append((now - SEND_TIME.unpack_from(buf, MEDIA_HEADER.size)[0]) * 1000)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def percentile(values: array.array, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p / 100 * len(values)))], 3)
+
+
+def cpu_seconds(pid: int) -> float:
+    # user + system time of a process and its relay workers, None where /proc is not available
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK') + sum(filter(None, map(cpu_seconds, children)))
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def server_stats(host: str, port: int = STATS_PORT) -> dict:
+    # the relay's own counters, see STATS_PORT in server.py; None if it is not reachable
+    try:
+        with socket.create_connection((host, port), timeout=2) as conn:
+            conn.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            response = b''
+            while data := conn.recv(65536):
+                response += data
+        return json.loads(response.split(b'\r\n\r\n', 1)[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def relay_dropped(host: str, media: str, relays: int = 1) -> int:
+    # datagrams the relays could not send on, summed over every worker when rooms are sharded
+    # and over every link when relays are cascaded
+    stats = []
+    for index in range(relays):
+        front = server_stats(host, STATS_PORT + index * RELAY_PORT_STEP)
+        if front is None:
+            return None
+        stats.append(front)
+        if 'workers' in front:
+            stats[-1:] = [server_stats(host, worker['stats_port']) for worker in front['workers']]
+    return sum(c['received'][media]['lost'] for relay in stats if relay
+               for members in relay['rooms'].values() for c in members.values()) \
+        + sum(peer['received'][media]['lost'] for relay in stats if relay for peer in relay['peers'].values())
+
+
+def start_server(workers: int = 0, node: int = 0, prioritize: bool = False) -> subprocess.Popen:
+    # relay n of a cascade listens RELAY_PORT_STEP * n above the default ports and links to every earlier one;
+    # unless prioritizing, every frame goes to everyone whoever speaks, so loss stays exact
+    offset = node * RELAY_PORT_STEP
+    command = [sys.executable, 'server.py', '--workers', str(workers), '--node', str(node), '--offset', str(offset)]
+    if not prioritize:
+        command += ['--priority-members', '0']
+    for index in range(node):
+        command += ['--peer', f"{HOST}:{MAIN_PORT + index * RELAY_PORT_STEP}"]
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        stats = server_stats(HOST, STATS_PORT + offset)
+        if stats is not None and len(stats.get('peers', ())) == node:
+            return server
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def stop_server(server: subprocess.Popen):
+    # SIGINT lets server.py disconnect everyone and remove its file cache
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def run_step(num_clients: int, args) -> dict:
+    servers = []
+    fake_clients = []
+    try:
+        if not args.no_spawn:
+            for node in range(args.relays):
+                servers.append(start_server(args.workers, node, args.speakers > 0))
+        # rooms span the cascade: client i joins room i % rooms on relay i % relays
+        fake_clients = [FakeClient(f"bench{i}", args.host, f"room{i % args.rooms}", MAIN_PORT + i % args.relays * RELAY_PORT_STEP,
+                                   args.audio_codec)
+                        for i in range(num_clients)]
+        room_sizes = {}
+        for fake in fake_clients:
+            room_sizes[fake.room] = room_sizes.get(fake.room, 0) + 1
+        # the first --speakers clients of every room talk, the relay only keeps the others' video alive
+        for i, fake in enumerate(fake_clients):
+            if i // args.rooms < args.speakers:
+                fake.level = SPEECH_LEVEL
+        keep_alive_ids = {fake.id for fake in fake_clients if fake.level == SILENT_LEVEL} if args.speakers else set()
+        receiver = Receiver(fake_clients, keep_alive_ids)
+        receiver.start()
+        time.sleep(WARMUP)
+
+        frame, block = fake_jpeg(args.frame_bytes), fake_audio(args.audio_codec)
+        if args.speakers:
+            warmup_end = time.perf_counter() + SPEAKER_WARMUP
+            while time.perf_counter() < warmup_end:
+                for fake in fake_clients:
+                    fake.send(AUDIO, block)
+                time.sleep(BLOCK_SIZE / SAMPLE_RATE)
+            receiver.received[AUDIO] = receiver.bytes[AUDIO] = 0
+            receiver.latencies[AUDIO] = array.array('d')
+        sent = {VIDEO: 0, AUDIO: 0}
+        expected = {VIDEO: 0, AUDIO: 0} # every datagram goes to everyone in its room but its sender
+        intervals = {VIDEO: 1 / args.fps, AUDIO: BLOCK_SIZE / SAMPLE_RATE}
+        media_list = [VIDEO] + ([AUDIO] if args.audio else [])
+        cpu_start = [cpu_seconds(server.pid) for server in servers]
+        start = time.perf_counter()
+        next_send = {media: start for media in media_list}
+        while (now := time.perf_counter()) - start < args.duration:
+            media = min(media_list, key=next_send.get)
+            if next_send[media] > now:
+                time.sleep(next_send[media] - now)
+            for fake in fake_clients:
+                count = fake.send(media, frame if media == VIDEO else block)
+                sent[media] += count
+                if media == AUDIO or fake.id not in keep_alive_ids:
+                    expected[media] += count * (room_sizes[fake.room] - 1)
+            next_send[media] += intervals[media]
+        elapsed = time.perf_counter() - start
+        cpu_end = [cpu_seconds(server.pid) for server in servers]
+        time.sleep(DRAIN)
+        receiver.stop()
+
+        result = {'clients': num_clients, 'rooms': len(room_sizes), 'relays': args.relays, 'speakers': args.speakers,
+                  'seconds': round(elapsed, 2)}
+        if servers and None not in cpu_start + cpu_end:
+            result['server_cpu_percent'] = round((sum(cpu_end) - sum(cpu_start)) / elapsed * 100, 1)
+        for media in media_list:
+            received = receiver.received[media]
+            latencies = receiver.latencies[media]
+            result[media] = {
+                'sent': sent[media],
+                'expected': expected[media],
+                'received': received,
+                'loss_percent': round((1 - received / expected[media]) * 100, 2) if expected[media] else 0.0,
+                'receive_pps': round(received / elapsed, 1),
+                'relay_mbps': round(receiver.bytes[media] * 8 / elapsed / 1e6, 2),
+                'latency_ms': {p: percentile(latencies, p) for p in (50, 95, 99)},
+            }
+            if media == VIDEO and keep_alive_ids:
+                result[media]['keep_alive_pps'] = round(receiver.keep_alive / elapsed, 1) # not in expected nor received
+            dropped = relay_dropped(args.host, media, args.relays)
+            if dropped is not None:
+                result[media]['relay_dropped'] = dropped
+        return result
+    finally:
+        for fake in fake_clients:
+            fake.close()
+        for server in servers:
+            stop_server(server)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_step(result: dict):
+    for media in (VIDEO, AUDIO):
+        if media not in result:
+            continue
+        r = result[media]
+        keep_alive = f"keep-alive {r['keep_alive_pps']:.0f} pkt/s " if 'keep_alive_pps' in r else ""
+        print(f"[BENCH] {result['clients']:>4} clients {result['rooms']:>3} rooms {result['relays']:>2} relays {media:<5} "
+              f"{r['receive_pps']:>9.0f} pkt/s {r['relay_mbps']:>8.2f} Mbit/s "
+              f"loss {r['loss_percent']:>6.2f}% {keep_alive}"
+              f"latency p50 {r['latency_ms'][50]:.2f} p95 {r['latency_ms'][95]:.2f} p99 {r['latency_ms'][99]:.2f} ms "
+              f"cpu {result.get('server_cpu_percent', '-')}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the relay with headless synthetic clients")
+    parser.add_argument('--clients', default=','.join(map(str, CLIENT_COUNTS)),
+                        help="comma separated participant counts to sweep")
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--fps', type=float, default=VIDEO_FPS)
+    parser.add_argument('--frame-bytes', type=int, default=FRAME_BYTES)
+    parser.add_argument('--audio', action='store_true', help="also stream audio blocks at the block rate")
+    parser.add_argument('--audio-codec', choices=AUDIO_CODECS, default=AUDIO_CODECS[0], help="codec of the audio blocks")
+    parser.add_argument('--rooms', type=int, default=1, help="clients are spread evenly over this many rooms")
+    parser.add_argument('--workers', type=int, default=0, help="relay worker processes of the spawned server")
+    parser.add_argument('--relays', type=int, default=1, help="cascaded relays the clients are spread over")
+    parser.add_argument('--speakers', type=int, default=0,
+                        help="clients of each room that talk, the relay prioritizes their video; 0 disables prioritization")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--no-spawn', action='store_true', help="use a server that is already running")
+    parser.add_argument('--output', help="write the report as JSON, to compare across commits")
+    args = parser.parse_args()
+    if args.relays > 1 and args.workers:
+        parser.error("cascaded relays run without --workers")
+    if args.speakers and not args.audio:
+        parser.error("--speakers needs --audio, the relay ranks speakers by their audio")
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': {'duration': args.duration, 'fps': args.fps, 'frame_bytes': args.frame_bytes, 'audio': args.audio, 'audio_codec': args.audio_codec,
+                   'rooms': args.rooms, 'workers': args.workers, 'relays': args.relays, 'speakers': args.speakers},
+        'steps': [],
+    }
+    for num_clients in (int(n) for n in args.clients.split(',')):
+        result = run_step(num_clients, args)
+        print_step(result)
+        report['steps'].append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"[BENCH] Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,74 @@
 import os
-import time
 import sys
 import socket
-import pickle
-from collections import defaultdict
+import asyncio
 
-from PyQt6.QtCore import QThreadPool, QRunnable, QThread, pyqtSignal, pyqtSlot
-from PyQt6.QtWidgets import QApplication, QMessageBox
-from qt_gui import MainWindow, Camera, Microphone, Worker
+from PyQt6.QtCore import QThread, pyqtSignal
+from PyQt6.QtWidgets import QApplication
+from qt_gui import MainWindow, Camera, Microphone
 
 from constants import *
+from client_core import ClientCore, Participant
+from stats import StreamStats
 
 IP = socket.gethostbyname(socket.gethostname())
 # IP = "192.168.12.1"
-VIDEO_ADDR = (IP, VIDEO_PORT)
-AUDIO_ADDR = (IP, AUDIO_PORT)
+DISCONNECT_TIMEOUT = 2.0 # seconds to wait for the goodbye to reach the server on exit
 
 
 class Client:
-    def __init__(self, name: str, current_device = False):
+    def __init__(self, name: str, current_device = False, id: int = 0, participant: Participant = None):
         self.name = name
         self.current_device = current_device
+        self.id = id
+        self.participant = participant # protocol state of a remote client, from the core
 
         self.video_frame = None
+        self.video_version = 0 # bumped whenever video_frame changes
+        self.captured = 0 # number of the camera frame in video_frame
         self.audio_data = None
 
         if self.current_device:
             self.camera = Camera()
             self.microphone = Microphone()
+            self.jitter_buffer = None
+            self.stats = {VIDEO: StreamStats(), AUDIO: StreamStats()} # replaced by the core's on connect
         else:
             self.camera = None
             self.microphone = None
-        
+            self.jitter_buffer = participant.jitter_buffer
+            self.stats = participant.stats
+
         self.camera_enabled = True
         self.microphone_enabled = True
+        self.decode_ms = 0.0 # moving average of the time to decode and scale one frame
+        self.speaking = False # among the room's active speakers, as ranked by the server
+
+    def is_muted(self):
+        if self.current_device:
+            return self.audio_data is None
+        return self.participant.is_muted()
 
     def get_video(self):
+        # the newest camera frame, for the self view; never blocks
         if not self.camera_enabled:
-            self.video_frame = None
+            self.set_video(None)
             return None
 
         if self.camera is not None:
-            self.video_frame = self.camera.get_frame()
+            count, frame = self.camera.latest('view')
+            if count != self.captured or self.video_frame is None:
+                self.captured = count
+                self.set_video(frame)
 
         return self.video_frame
-    
+
+    def set_video(self, frame):
+        if frame is None and self.video_frame is None:
+            return
+        self.video_frame = frame
+        self.video_version += 1
+
     def get_audio(self):
         if not self.microphone_enabled:
             self.audio_data = None
@@ -57,180 +81,118 @@ class Client:
 
 
 class ServerConnection(QThread):
+    # Qt adapter over ClientCore: runs its event loop on this thread and turns
+    # core events into signals, GUI calls are handed to the loop thread-safely
     add_client_signal = pyqtSignal(Client)
     remove_client_signal = pyqtSignal(str)
     add_msg_signal = pyqtSignal(str, str)
+    file_progress_signal = pyqtSignal(str, int, int) # filename, bytes done, total bytes
+    connect_failed_signal = pyqtSignal(str)
+    speakers_signal = pyqtSignal(list) # names of the active speakers, loudest first
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.threadpool = QThreadPool()
-
-        self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.audio_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        self.connected = False
-        self.recieving_filename = None
+        self.name = None
+        self.room = DEFAULT_ROOM
+        self.loop = None
+        self.encoded = 0 # number of the last camera frame handed to the encoder
+        self.core = ClientCore(IP)
+        self.mixed_audio = self.core.mixed_audio
+
+        self.core.on('add', self.on_add)
+        self.core.on('remove', self.on_remove)
+        self.core.on('video', self.on_video)
+        self.core.on('speakers', self.on_speakers)
+        self.core.on('text', self.add_msg_signal.emit)
+        self.core.on('file_offer', lambda from_name, info: self.add_msg_signal.emit(from_name, f"Recieving {info.filename}..."))
+        self.core.on('file_progress', self.file_progress_signal.emit)
+        self.core.on('file_sent', self.on_file_sent)
+        self.core.on('file_received', self.on_file_received)
 
     def run(self):
-        self.init_conn() # Connect to all servers and send name
-        self.start_conn_threads() # Start receiving threads for all servers
-        self.start_broadcast_threads() # Start sending threads for audio and video
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.session())
 
+    async def session(self):
+        try:
+            await self.core.connect(self.name, self.room)
+        except (OSError, ConnectionError) as e:
+            self.connect_failed_signal.emit(str(e))
+            return
+        client.name = self.name
+        client.id = self.core.id
+        client.stats = self.core.stats
         self.add_client_signal.emit(client)
+        await asyncio.gather(
+            self.core.stream_video(self.capture_video),
+            self.core.stream_audio(client.get_audio),
+            self.core.wait_closed(),
+        )
+
+    def capture_video(self):
+        # encoder thread: the next camera frame, apart from the self view which reads the camera itself
+        if not client.camera_enabled or client.camera is None:
+            return None
+        self.encoded, frame = client.camera.next_frame('encoder', self.encoded)
+        return frame
+
+    def on_add(self, participant: Participant):
+        all_clients[participant.name] = Client(participant.name, id=participant.id, participant=participant)
+        self.add_client_signal.emit(all_clients[participant.name])
+
+    def on_remove(self, participant: Participant):
+        self.remove_client_signal.emit(participant.name)
+        all_clients.pop(participant.name, None)
+
+    def on_video(self, participant: Participant, frame: bytes):
+        if participant.name in all_clients:
+            all_clients[participant.name].set_video(frame)
+
+    def on_speakers(self, names: list):
+        # tiles pick the flag up on their next refresh
+        client.speaking = client.name in names
+        for name, other in tuple(all_clients.items()):
+            other.speaking = name in names
+        self.speakers_signal.emit(list(names))
+
+    def on_file_sent(self, filename: str, ok: bool, status: str):
+        if not ok:
+            self.add_msg_signal.emit(self.name, f"File {filename} could not be sent. {status or ''}")
+            return
+        self.add_msg_signal.emit(self.name, f"File {filename} sent.")
 
-        while self.connected:
-            pass
-        self.disconnect_server()
-
-    def init_conn(self):
-        self.main_socket.connect((IP, MAIN_PORT))
-
-        client.name = self.name
-        self.main_socket.send_bytes(self.name.encode())
-        conn_status = self.main_socket.recv_bytes().decode()
-        if conn_status != OK:
-            QMessageBox.critical(None, "Error", conn_status)
-            self.main_socket.close()
-            window.close()
+    def on_file_received(self, from_name: str, filename: str, ok: bool):
+        if not ok:
+            self.add_msg_signal.emit(from_name, f"File {filename} could not be recieved.")
             return
-        
-        self.send_msg(self.video_socket, Message(self.name, ADD, VIDEO))
-        self.send_msg(self.audio_socket, Message(self.name, ADD, AUDIO))
+        self.add_msg_signal.emit(from_name, f"File {filename} recieved.")
 
-        self.connected = True
-    
-    def start_conn_threads(self):
-        self.main_conn_thread = Worker(self.handle_conn, self.main_socket, TEXT)
-        self.threadpool.start(self.main_conn_thread)
+    def call(self, fn, *args):
+        # run a core method on the connection's event loop, from the GUI thread
+        if self.loop is not None and self.core.connected:
+            self.loop.call_soon_threadsafe(fn, *args)
 
-        self.video_conn_thread = Worker(self.handle_conn, self.video_socket, VIDEO)
-        self.threadpool.start(self.video_conn_thread)
+    def send_text(self, to_names: tuple[str], text: str):
+        self.call(self.core.send_text, to_names, text)
 
-        self.audio_conn_thread = Worker(self.handle_conn, self.audio_socket, AUDIO)
-        self.threadpool.start(self.audio_conn_thread)
+    def send_subscriptions(self, subscriptions: dict):
+        self.call(self.core.send_subscriptions, subscriptions)
 
-    def start_broadcast_threads(self):
-        self.video_broadcast_thread = Worker(self.media_broadcast_loop, self.video_socket, VIDEO)
-        self.threadpool.start(self.video_broadcast_thread)
+    def send_file(self, filepath: str, to_names: tuple[str]):
+        if self.loop is not None and self.core.connected:
+            asyncio.run_coroutine_threadsafe(self.core.send_file(filepath, to_names), self.loop)
 
-        self.audio_broadcast_thread = Worker(self.media_broadcast_loop, self.audio_socket, AUDIO)
-        self.threadpool.start(self.audio_broadcast_thread)
-    
     def disconnect_server(self):
-        self.send_msg(self.main_socket, Message(self.name, DISCONNECT))
-        self.main_socket.disconnect()
-    
-    def send_msg(self, conn: socket.socket, msg: Message):
-        msg_bytes = pickle.dumps(msg)
-        # print("Sending..", len(msg_bytes))
+        if self.loop is None or not self.core.connected:
+            return
         try:
-            if msg.data_type == VIDEO:
-                conn.sendto(msg_bytes, VIDEO_ADDR)
-            elif msg.data_type == AUDIO:
-                conn.sendto(msg_bytes, AUDIO_ADDR)
-            else:
-                conn.send_bytes(msg_bytes)
-        except (BrokenPipeError, ConnectionResetError, OSError):
-            print(f"[ERROR] Connection not present")
-            self.connected = False
-    
-    def send_file(self, filepath: str, to_names: tuple[str]):
-        filename = os.path.basename(filepath)
-        with open(filepath, 'rb') as f:
-            data = f.read(SIZE)
-            while data:
-                msg = Message(self.name, POST, FILE, data, to_names)
-                self.send_msg(self.main_socket, msg)
-                data = f.read(SIZE)
-            msg = Message(self.name, POST, FILE, None, to_names)
-            self.send_msg(self.main_socket, msg)
-        self.add_msg_signal.emit(self.name, f"File {filename} sent.")
-    
-    def media_broadcast_loop(self, conn: socket.socket, media: str):
-        while self.connected:
-            if media == VIDEO:
-                data = client.get_video()
-            elif media == AUDIO:
-                data = client.get_audio()
-            else:
-                print(f"[ERROR] Invalid media type")
-                break
-            msg = Message(self.name, POST, media, data)
-            self.send_msg(conn, msg)
-
-    def handle_conn(self, conn: socket.socket, media: str):
-        while self.connected:
-            if media in [VIDEO, AUDIO]:
-                msg_bytes, _ = conn.recvfrom(MEDIA_SIZE[media])
-            else:
-                msg_bytes = conn.recv_bytes()
-            if not msg_bytes:
-                self.connected = False
-                break
-            try:
-                msg = pickle.loads(msg_bytes)
-            except pickle.UnpicklingError:
-                print(f"[{self.name}] [{media}] [ERROR] UnpicklingError")
-                continue
-
-            if msg.request == DISCONNECT:
-                self.connected = False
-                break
-            try:
-                self.handle_msg(msg)
-            except Exception as e:
-                print(f"[{self.name}] [{media}] [ERROR] {e}")
-                continue
-
-    def handle_msg(self, msg: Message):
-        global all_clients
-        client_name = msg.from_name
-        if msg.request == POST:
-            if client_name not in all_clients:
-                print(f"[{self.name}] [ERROR] Invalid client name {client_name}: {msg}")
-                return
-            if msg.data_type == VIDEO:
-                all_clients[client_name].video_frame = msg.data
-            elif msg.data_type == AUDIO:
-                all_clients[client_name].audio_data = msg.data
-            elif msg.data_type == TEXT:
-                self.add_msg_signal.emit(client_name, msg.data)
-            elif msg.data_type == FILE:
-                if type(msg.data) == str:
-                    if os.path.exists(msg.data): # create copy
-                        filename, ext = os.path.splitext(msg.data)
-                        i = 1
-                        while os.path.exists(f"{filename}({i}){ext}"):
-                            i += 1
-                        msg.data = f"{filename}({i}){ext}"
-                    self.recieving_filename = msg.data
-                    with open(self.recieving_filename, 'wb') as f:
-                        pass
-                elif msg.data is None:
-                    self.add_msg_signal.emit(client_name, f"File {self.recieving_filename} recieved.")
-                    self.recieving_filename = None
-                else:
-                    with open(self.recieving_filename, 'ab') as f:
-                        f.write(msg.data)
-            else:
-                print(f"[{self.name}] [ERROR] Invalid data type {msg.data_type}")
-        elif msg.request == ADD:
-            if client_name in all_clients:
-                print(f"[{self.name}] [ERROR] Client already exists with name {client_name}")
-                return
-            all_clients[client_name] = Client(client_name)
-            self.add_client_signal.emit(all_clients[client_name])
-        elif msg.request == RM:
-            if client_name not in all_clients:
-                print(f"[{self.name}] [ERROR] Invalid client name {client_name}")
-                return
-            self.remove_client_signal.emit(client_name)
-            all_clients.pop(client_name)
+            asyncio.run_coroutine_threadsafe(self.core.disconnect(), self.loop).result(DISCONNECT_TIMEOUT)
+        except Exception as e:
+            print(f"[{self.name}] [ERROR] {e}")
 
 client = Client("You", current_device=True)
 
-all_clients = defaultdict(lambda: Client(""))
+all_clients = {} # name -> Client, remote clients only
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -241,4 +203,4 @@ if __name__ == "__main__":
 
     status_code = app.exec()
     server_conn.disconnect_server()
-    os._exit(status_code)
\ No newline at end of file
+    os._exit(status_code)
@@ -0,0 +1,599 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import struct
+import time
+from collections import defaultdict
+import cv2
+import numpy as np
+
+from constants import *
+from audio import JitterBuffer, VoiceDetector, block_level
+from audio_codec import available_codecs, choose_codec, get_audio_codec
+from codec import DeltaEncoder, DeltaDecoder, MIN_QUALITY
+from media import fragment, Reassembler, ReceiveStats, RateController, Pacer, REPORT_INTERVAL, PACING_FACTOR
+from media import FecDecoder, VideoParity, AudioParity, fec_group, FEC_HEADER, VIDEO_FRAGMENT
+from stats import StreamStats
+
+FILE_RETRIES = 5 # reconnect attempts for an interrupted file transfer
+PART_SUFFIX = '.part' # appended to a file's name while it is being received
+MUTE_TIMEOUT = 0.5 # a remote client counts as muted this long after its last empty audio block
+SUPPRESS_SILENCE = True # send comfort noise markers instead of blocks the voice detector finds silent
+COMFORT_INTERVAL = 1.0 # seconds between comfort noise markers while silent
+REFRESH_RETRY = 0.5 # seconds between requests for a refresh from a sender whose deltas cannot be shown
+
+# The protocol side of a client, with no Qt, camera or audio device: one asyncio
+# task per connection, events delivered to callbacks registered with on() and to
+# every iterator returned by events().
+#
+# Events and their arguments:
+#   connected (id), disconnected ()
+#   add (Participant), remove (Participant)
+#   video (Participant, frame: JPEG bytes of a refresh, DeltaFrame of a delta, None for camera off)
+#   audio (Participant, MediaPacket), mixed_audio (MediaPacket)
+#   speakers (names of the room's active speakers, loudest first)
+#   text (from name, text), file_offer (from name, FileInfo)
+#   file_progress (filename, bytes done, total bytes)
+#   file_sent (filename, ok, status), file_received (from name, filename, ok)
+
+
+class Participant:
+    # a remote client as seen by the core
+    def __init__(self, name: str, id: int, buffer_audio: bool = True, audio_codecs: tuple[str] = (AUDIO_CODECS[0],)):
+        self.name = name
+        self.id = id
+        self.audio_codecs = audio_codecs # what it decodes, from its ADD
+        self.video_frame = None # JPEG of a refresh or DeltaFrame to patch onto one, None while the camera is off
+        self.video_decoders = defaultdict(DeltaDecoder) # layer -> its refresh and the deltas on it
+        self.refresh_requested = 0.0 # last time this sender was asked for a refresh
+        self.muted_at = 0.0 # last time an empty audio block arrived
+        self.jitter_buffer = JitterBuffer() if buffer_audio else None
+        self.stats = {VIDEO: StreamStats(), AUDIO: StreamStats()}
+        self.receive_stats = ReceiveStats() # video loss and delay reported back to the sender
+
+    def is_muted(self) -> bool:
+        return time.monotonic() - self.muted_at < MUTE_TIMEOUT
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    # one length-prefixed message, b'' once the connection is closed
+    try:
+        header = await reader.readexactly(4)
+        return await reader.readexactly(struct.unpack('>I', header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return b''
+
+
+def file_digest(filepath: str) -> str:
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for data in iter(lambda: f.read(FILE_CHUNK), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def unique_filename(filename: str) -> str:
+    # name(1).ext, name(2).ext, ... when the file already exists
+    if not os.path.exists(filename):
+        return filename
+    name, ext = os.path.splitext(filename)
+    i = 1
+    while os.path.exists(f"{name}({i}){ext}"):
+        i += 1
+    return f"{name}({i}){ext}"
+
+
+def safe_filename(filename) -> str:
+    # last component of a name chosen by the sender, '' when nothing usable is left
+    if not isinstance(filename, str) or '\0' in filename:
+        return ''
+    name = os.path.basename(filename.replace('\\', '/'))
+    return '' if name in ('.', '..') else name
+
+
+class MediaProtocol(asyncio.DatagramProtocol):
+    def __init__(self, core: "ClientCore", media: str):
+        self.core = core
+        self.media = media
+
+    def datagram_received(self, data: bytes, addr):
+        self.core.handle_datagram(self.media, data)
+
+    def error_received(self, exc: Exception):
+        print(f"[{self.core.name}] [{self.media}] [ERROR] {exc}")
+
+
+class ClientCore:
+    def __init__(self, host: str, buffer_audio: bool = True, auto_download: bool = True, download_dir: str = '.',
+                 port: int = MAIN_PORT):
+        self.host = host
+        self.port = port # main port of the relay
+        self.buffer_audio = buffer_audio # keep a jitter buffer per participant, for playback
+        self.auto_download = auto_download # download every file offered, as soon as it is offered
+        self.download_dir = download_dir
+
+        self.name = None
+        self.room = DEFAULT_ROOM
+        self.id = 0
+        self.ports = {VIDEO: VIDEO_PORT, AUDIO: AUDIO_PORT, FILE: FILE_PORT} # sent by the relay at login
+        self.connected = False
+        self.participants = {} # name -> Participant
+        self.names = {} # sender id -> name, for media packets
+        self.subscriptions = None
+        self.reassembler = Reassembler()
+        self.rate_controller = RateController()
+        self.pacer = Pacer(self.rate_controller.bitrate * PACING_FACTOR)
+        self.mixed_audio = JitterBuffer() if buffer_audio else None # everyone else's audio, when the server mixes
+        self.mix_stats = StreamStats() # of the mixed audio, its loss is reported back to the server
+        self.stats = {VIDEO: StreamStats(), AUDIO: StreamStats()} # what we send
+        self.seq = {VIDEO: 0, AUDIO: 0}
+        self.video_encoders = [DeltaEncoder() for _ in VIDEO_LAYERS]
+        self.refresh = set() # layers receivers asked a refresh of, each encoder holds off repeats
+        self.fec_decoder = FecDecoder()
+        self.video_parity = VideoParity()
+        self.audio_parity = AudioParity()
+        self.fec_groups = {VIDEO: 0, AUDIO: 0} # datagrams per parity we send, from the receivers' reports
+        self.relay_audio_loss = 0.0 # of our audio on its way to the relay, reported by the relay when it mixes
+        self.audio_codecs = available_codecs() # what we decode, sent at login
+        self.relay_codecs = None # what the relay decodes, only when it mixes audio itself
+        self.audio_encoder = get_audio_codec(AUDIO_CODECS[0])
+        self.voice_detector = VoiceDetector()
+        self.comfort_sent = None # when the last comfort noise marker went out, None while talking
+        self.speakers = [] # names of the room's active speakers, loudest first, from the server
+
+        self.callbacks = defaultdict(list) # event -> callbacks
+        self.queues = [] # one per events() iterator
+        self.reader = None
+        self.writer = None
+        self.transports = {} # media -> datagram transport
+        self.tasks = []
+        self.closed = None
+
+    def on(self, event: str, callback):
+        self.callbacks[event].append(callback)
+
+    def emit(self, event: str, *args):
+        for callback in self.callbacks[event]:
+            callback(*args)
+        for queue in self.queues:
+            queue.put_nowait((event, *args))
+
+    async def events(self):
+        # async iterator over (event, *args) tuples, ends after disconnected
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                yield event
+                if event[0] == 'disconnected':
+                    return
+        finally:
+            self.queues.remove(queue)
+
+    async def connect(self, name: str, room: str = DEFAULT_ROOM):
+        # raises ConnectionError with the server's reason if the name is refused
+        self.name = name
+        self.room = room
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(frame_bytes(f"{name} {room} {','.join(self.audio_codecs)}".encode()))
+        status = (await read_frame(self.reader)).decode()
+        if status != OK:
+            self.writer.close()
+            raise ConnectionError(status or "Connection closed by server")
+        self.id = int((await read_frame(self.reader)).decode())
+        # the relay process that took the room, which may not be listening on the default ports,
+        # and the codecs it decodes when it mixes audio
+        video_port, audio_port, file_port, *relay_codecs = (await read_frame(self.reader)).decode().split()
+        self.ports = {VIDEO: int(video_port), AUDIO: int(audio_port), FILE: int(file_port)}
+        self.relay_codecs = parse_codecs(relay_codecs[0]) if relay_codecs else None
+        self.update_audio_codec()
+
+        loop = asyncio.get_running_loop()
+        for media in (VIDEO, AUDIO):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda media=media: MediaProtocol(self, media), remote_addr=(self.host, self.ports[media]))
+            self.transports[media] = transport
+            transport.sendto(MediaPacket(ADD, media, self.id).pack())
+
+        self.connected = True
+        self.closed = loop.create_future()
+        self.tasks = [asyncio.create_task(self.receive_loop()), asyncio.create_task(self.report_loop())]
+        self.emit('connected', self.id)
+
+    async def wait_closed(self):
+        if self.closed is not None:
+            await self.closed
+
+    async def disconnect(self):
+        if not self.connected:
+            return
+        self.send_msg(Message(self.name, DISCONNECT))
+        await self.close()
+
+    async def close(self):
+        if not self.connected:
+            return
+        self.connected = False
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        for transport in self.transports.values():
+            transport.close()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.closed.set_result(None)
+        self.emit('disconnected')
+
+    def send_msg(self, msg: Message):
+        # buffered by the transport, so this never blocks the loop
+        if not self.connected:
+            return
+        self.writer.write(frame_bytes(pickle.dumps(msg)))
+
+    def send_text(self, to_names: tuple[str], text: str):
+        self.send_msg(Message(self.name, POST, TEXT, text, to_names))
+
+    def send_subscriptions(self, subscriptions: dict):
+        # tell the server which videos we can show, and how large
+        if subscriptions == self.subscriptions:
+            return
+        self.subscriptions = subscriptions
+        self.send_msg(Message(self.name, SUBSCRIBE, VIDEO, subscriptions))
+
+    def encode_video(self, frame) -> list:
+        # worker thread: (payload, is refresh) per simulcast layer, smallest first, None while the camera is off
+        if frame is None:
+            for encoder in self.video_encoders:
+                encoder.reset()
+            return None
+        controller = self.rate_controller
+        refresh, self.refresh = self.refresh, set()
+        layers = []
+        for i, ((width, height, quality), encoder) in enumerate(zip(VIDEO_LAYERS[:controller.num_layers], self.video_encoders)):
+            layer = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            quality = max(MIN_QUALITY, quality - controller.quality_drop)
+            layers.append(encoder.encode(layer, self.seq[VIDEO], quality, i in refresh))
+        return layers
+
+    async def send_video(self, layers: list):
+        # one encoded frame, see encode_video (None for camera off); every layer shares
+        # the sequence number, datagrams and their parity are paced at the target bitrate
+        if not self.connected:
+            return
+        stats = self.stats[VIDEO]
+        self.pacer.bitrate = self.rate_controller.bitrate * PACING_FACTOR
+        sent = 0
+        for layer, (data, refresh) in enumerate(layers or [(b'', False)] * len(VIDEO_LAYERS)):
+            packet = MediaPacket(REFRESH if refresh else POST, VIDEO, self.id, self.seq[VIDEO], 0, data, layer)
+            fragments = fragment(packet, VIDEO_FRAGMENT)
+            for frag in fragments:
+                sent += await self.send_paced(frag)
+            # parity covers the timestamps the fragments went out with
+            parity = self.video_parity.add(fragments, self.fec_groups[VIDEO], refresh)
+            for frag in parity:
+                sent += await self.send_paced(frag)
+            stats.parity += len(parity)
+        stats.frames += 1
+        if layers:
+            self.rate_controller.on_frame(sent)
+        self.seq[VIDEO] = (self.seq[VIDEO] + 1) & 0xFFFFFFFF
+
+    async def send_paced(self, packet: MediaPacket) -> int:
+        # stamped as it leaves rather than when the frame was captured, so receivers do not
+        # take our own pacing for queuing delay
+        nbytes = MEDIA_HEADER.size + len(packet.data)
+        delay = self.pacer.delay(nbytes)
+        if delay:
+            await asyncio.sleep(delay)
+        packet.timestamp = timestamp_ms()
+        self.transports[VIDEO].sendto(packet.pack())
+        self.stats[VIDEO].add(nbytes)
+        return nbytes
+
+    def update_audio_codec(self):
+        # the smallest codec every receiver decodes, checked whenever someone joins or leaves
+        supported = [self.audio_codecs] + [participant.audio_codecs for participant in self.participants.values()]
+        if self.relay_codecs is not None:
+            supported = [self.audio_codecs, self.relay_codecs] # the relay decodes and mixes everything
+        name = choose_codec(*supported)
+        if name != self.audio_encoder.name:
+            self.audio_encoder = get_audio_codec(name)
+            print(f"[{self.name}] [{AUDIO}] Sending {self.audio_encoder.name}")
+
+    def send_audio(self, block: bytes):
+        # one block of PCM, None or empty while the microphone is off
+        if not self.connected:
+            return
+        data, layer, level = b'', AUDIO_CODECS.index(self.audio_encoder.name), SILENT_LEVEL
+        if block:
+            samples = np.frombuffer(block, dtype=np.int16)
+            if SUPPRESS_SILENCE and not self.voice_detector.is_speech(samples):
+                now = time.monotonic()
+                if self.comfort_sent is not None and now - self.comfort_sent < COMFORT_INTERVAL:
+                    return
+                self.comfort_sent = now
+                layer, level = COMFORT_NOISE, self.voice_detector.noise_level()
+            else:
+                self.comfort_sent = None
+                data, level = self.audio_encoder.encode(block), block_level(samples)
+        packet = MediaPacket(POST, AUDIO, self.id, self.seq[AUDIO], timestamp_ms(), data, layer, level=level)
+        self.transports[AUDIO].sendto(packet.pack())
+        self.stats[AUDIO].add(MEDIA_HEADER.size + len(packet.data))
+        self.stats[AUDIO].frames += 1
+        parity = self.audio_parity.add(packet, self.fec_groups[AUDIO])
+        if parity is not None:
+            self.transports[AUDIO].sendto(parity.pack())
+            self.stats[AUDIO].add(MEDIA_HEADER.size + len(parity.data))
+            self.stats[AUDIO].parity += 1
+        self.seq[AUDIO] = (self.seq[AUDIO] + 1) & 0xFFFFFFFF
+
+    async def stream_video(self, capture):
+        # capture() blocks for a BGR frame, None while the camera is off; it runs and the
+        # frame is encoded in a worker thread, at the frame rate set by the rate controller
+        controller = self.rate_controller
+        next_frame = time.monotonic()
+        while self.connected:
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_frame = max(next_frame + 1 / controller.fps, time.monotonic())
+            layers = await asyncio.to_thread(lambda: self.encode_video(capture()))
+            await self.send_video(layers)
+
+    async def stream_audio(self, capture):
+        # capture() blocks for one block of PCM, None while the microphone is off
+        while self.connected:
+            block = await asyncio.to_thread(capture)
+            if block is None:
+                # microphone off: keep sending empty blocks, but at the block rate
+                await asyncio.sleep(BLOCK_SIZE / SAMPLE_RATE)
+            self.send_audio(block)
+
+    async def receive_loop(self):
+        while self.connected:
+            msg_bytes = await read_frame(self.reader)
+            if not msg_bytes:
+                break
+            try:
+                msg = pickle.loads(msg_bytes)
+            except pickle.UnpicklingError:
+                print(f"[{self.name}] [{TEXT}] [ERROR] UnpicklingError")
+                continue
+            if msg.request == DISCONNECT:
+                break
+            try:
+                self.handle_msg(msg)
+            except Exception as e:
+                print(f"[{self.name}] [{TEXT}] [ERROR] {e}")
+        await self.close()
+
+    async def report_loop(self):
+        # report loss/delay to each sender and adapt our own video and redundancy to theirs,
+        # loss of the server's mix goes back to the server under its own name
+        while self.connected:
+            await asyncio.sleep(REPORT_INTERVAL)
+            reports = {}
+            for participant in tuple(self.participants.values()):
+                if participant.stats[VIDEO].packets or participant.stats[AUDIO].packets:
+                    report = participant.receive_stats.report()
+                    report.audio_loss = participant.stats[AUDIO].interval_loss()
+                    reports[participant.name] = report
+                    participant.stats[VIDEO].lost = participant.receive_stats.lost
+            if self.mix_stats.packets:
+                reports[SERVER] = ReceiverReport(0.0, 0.0, self.mix_stats.interval_loss())
+            if reports:
+                self.send_msg(Message(self.name, REPORT, VIDEO, reports))
+            self.rate_controller.update()
+            video_loss, audio_loss = self.rate_controller.worst_loss()
+            self.fec_groups = {VIDEO: fec_group(VIDEO, video_loss),
+                               AUDIO: fec_group(AUDIO, max(audio_loss, self.relay_audio_loss))}
+
+    def handle_datagram(self, media: str, data: bytes):
+        try:
+            packet = MediaPacket.unpack(data)
+        except (struct.error, IndexError):
+            print(f"[{self.name}] [{media}] [ERROR] Invalid media header")
+            return
+        if packet.sender_id == MIX_ID:
+            participant, stats, jitter_buffer = None, self.mix_stats, self.mixed_audio
+        else:
+            participant = self.participants.get(self.names.get(packet.sender_id, None), None)
+            if participant is None:
+                return # media can arrive before the ADD on the main connection
+            stats, jitter_buffer = participant.stats[media], participant.jitter_buffer
+
+        if packet.request == FEC:
+            stats.add(len(data))
+            stats.parity += 1
+            if media == AUDIO and jitter_buffer is not None and len(packet.data) >= FEC_HEADER.size:
+                jitter_buffer.protect(FEC_HEADER.unpack_from(packet.data)[2])
+            rebuilt = self.fec_decoder.add_parity(packet)
+        else:
+            # video loss comes from the per-frame fragment counts in report_loop,
+            # audio blocks are one datagram each so gaps in seq are losses
+            stats.add(len(data), packet.seq if media == AUDIO else None, packet.timestamp)
+            if media == VIDEO:
+                participant.receive_stats.add(packet)
+            self.handle_packet(media, participant, packet)
+            rebuilt = self.fec_decoder.add(packet)
+        for packet in rebuilt:
+            stats.recovered += 1
+            self.handle_packet(media, participant, packet, rebuilt=True)
+
+    def handle_packet(self, media: str, participant: Participant, packet: MediaPacket, rebuilt: bool = False):
+        # one datagram as received or rebuilt from parity, participant is None for the server's mix
+        if participant is None:
+            if self.mixed_audio is not None:
+                self.mixed_audio.put(packet, rebuilt)
+            self.emit('mixed_audio', packet)
+            return
+        stats = participant.stats[media]
+        if media == VIDEO:
+            packet = self.reassembler.add(packet)
+            if packet is None:
+                return
+            frame = None
+            if packet.data:
+                frame = participant.video_decoders[packet.layer].decode(packet.seq, bytes(packet.data))
+                if frame is None:
+                    self.request_refresh(participant, packet.layer) # the refresh these tiles patch never arrived
+                    return
+            stats.frames += 1
+            stats.queue_depth = len(self.reassembler.frames)
+            if frame is not None and frame is participant.video_frame:
+                return # a delta with no changed tiles
+            participant.video_frame = frame
+            self.emit('video', participant, frame)
+        else:
+            if not packet.data and packet.layer != COMFORT_NOISE:
+                participant.muted_at = time.monotonic()
+            if participant.jitter_buffer is not None:
+                participant.jitter_buffer.put(packet, rebuilt)
+                stats.queue_depth = len(participant.jitter_buffer.blocks)
+            stats.frames += 1
+            self.emit('audio', participant, packet)
+
+    def request_refresh(self, participant: Participant, layer: int):
+        # only the layer we get is refreshed, for everyone who gets it
+        now = time.monotonic()
+        if now - participant.refresh_requested < REFRESH_RETRY:
+            return
+        participant.refresh_requested = now
+        self.send_msg(Message(self.name, REFRESH, VIDEO, layer, (participant.name,)))
+
+    def handle_msg(self, msg: Message):
+        from_name = msg.from_name
+        if msg.request == SPEAKERS:
+            self.speakers = msg.data
+            self.emit('speakers', self.speakers)
+        elif msg.request == POST:
+            if from_name not in self.participants:
+                print(f"[{self.name}] [ERROR] Invalid client name {from_name}: {msg}")
+                return
+            if msg.data_type == TEXT:
+                self.emit('text', from_name, msg.data)
+            elif msg.data_type == FILE:
+                self.emit('file_offer', from_name, msg.data)
+                if self.auto_download:
+                    self.tasks.append(asyncio.create_task(self.receive_file(from_name, msg.data)))
+            else:
+                print(f"[{self.name}] [ERROR] Invalid data type {msg.data_type}")
+        elif msg.request == REPORT:
+            if from_name == SERVER:
+                self.relay_audio_loss = msg.data.audio_loss # the relay mixes, and lost this much of our audio
+            else:
+                self.rate_controller.on_report(from_name, msg.data)
+        elif msg.request == REFRESH:
+            if type(msg.data) is int and 0 <= msg.data < len(VIDEO_LAYERS):
+                self.refresh.add(msg.data)
+        elif msg.request == ADD:
+            if from_name in self.participants:
+                print(f"[{self.name}] [ERROR] Client already exists with name {from_name}")
+                return
+            id, audio_codecs = msg.data
+            participant = self.participants[from_name] = Participant(from_name, id, self.buffer_audio, audio_codecs)
+            self.names[participant.id] = from_name
+            self.update_audio_codec()
+            self.emit('add', participant)
+        elif msg.request == RM:
+            participant = self.participants.pop(from_name, None)
+            if participant is None:
+                print(f"[{self.name}] [ERROR] Invalid client name {from_name}")
+                return
+            self.names.pop(participant.id, None)
+            self.reassembler.remove(participant.id)
+            self.rate_controller.reports.pop(from_name, None)
+            self.update_audio_codec()
+            self.emit('remove', participant)
+
+    async def send_file(self, filepath: str, to_names: tuple[str]) -> bool:
+        # upload on its own connection so chat and control messages are never blocked
+        filename = os.path.basename(filepath)
+        size = os.path.getsize(filepath)
+        info = FileInfo(filename, size, await asyncio.to_thread(file_digest, filepath))
+        loop = asyncio.get_running_loop()
+
+        status = None
+        for _ in range(FILE_RETRIES):
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.ports[FILE])
+                try:
+                    writer.write(frame_bytes(pickle.dumps(Message(self.name, POST, FILE, info, to_names, self.room))))
+                    # the server answers with what it already has: the whole file if cached,
+                    # part of it if an earlier upload was interrupted
+                    sent = int((await read_frame(reader)).decode() or 0)
+                    with open(filepath, 'rb') as f:
+                        while sent < size:
+                            # zero-copy from the page cache where the OS supports it
+                            sent += await loop.sendfile(writer.transport, f, sent, min(FILE_CHUNK, size - sent))
+                            self.emit('file_progress', filename, sent, size)
+                    status = (await read_frame(reader)).decode()
+                finally:
+                    writer.close()
+                break
+            except (OSError, ValueError) as e:
+                print(f"[{self.name}] [ERROR] Sending {filename} interrupted: {e}")
+                await asyncio.sleep(1)
+        self.emit('file_sent', filename, status == OK, status)
+        return status == OK
+
+    async def receive_file(self, from_name: str, info: FileInfo) -> bool:
+        name = safe_filename(info.filename)
+        if not name:
+            print(f"[{self.name}] [ERROR] Invalid file name {info.filename!r} from {from_name}")
+            self.emit('file_received', from_name, str(info.filename), False)
+            return False
+        filename = os.path.join(self.download_dir, name)
+        # written under a temporary name, which only becomes filename once every chunk checked out
+        part_filename = unique_filename(filename + PART_SUFFIX)
+        received = 0 # bytes written and verified, a reconnect resumes from here
+        try:
+            with open(part_filename, 'wb') as f:
+                fd = f.fileno()
+                # reserve the whole file up front, chunks are written in place
+                if hasattr(os, 'posix_fallocate') and info.size:
+                    os.posix_fallocate(fd, 0, info.size)
+                else:
+                    f.truncate(info.size)
+                for _ in range(FILE_RETRIES):
+                    try:
+                        received = await self.download_chunks(fd, info, received, filename)
+                    except OSError as e:
+                        print(f"[{self.name}] [ERROR] Receiving {filename} interrupted: {e}")
+                    if received >= info.size:
+                        break
+                    await asyncio.sleep(1)
+            if received >= info.size:
+                filename = unique_filename(filename)
+                os.replace(part_filename, filename)
+        finally:
+            if received < info.size and os.path.exists(part_filename):
+                os.remove(part_filename)
+        self.emit('file_received', from_name, filename, received >= info.size)
+        return received >= info.size
+
+    async def download_chunks(self, fd: int, info: FileInfo, received: int, filename: str) -> int:
+        # pull the file from the server cache starting at received, verifying each chunk
+        reader, writer = await asyncio.open_connection(self.host, self.ports[FILE])
+        try:
+            writer.write(frame_bytes(pickle.dumps(Message(self.name, GET, FILE, (info.digest, received)))))
+            while received < info.size:
+                length = min(FILE_CHUNK, info.size - received)
+                try:
+                    chunk = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    return received
+                if hashlib.sha256(chunk).hexdigest() != info.chunk_digests[received // FILE_CHUNK]:
+                    print(f"[{self.name}] [ERROR] Checksum mismatch in {filename} at {received}")
+                    return received
+                os.pwrite(fd, chunk, received)
+                received += length
+                self.emit('file_progress', os.path.basename(filename), received, info.size)
+        finally:
+            writer.close()
+        return received
@@ -0,0 +1,308 @@
+import struct
+import threading
+import time
+import cv2
+import numpy as np
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# 'turbojpeg', 'simplejpeg' or 'opencv', None picks the fastest one installed
+JPEG_BACKEND = None
+# reduced decoding factors supported by libjpeg's scaled DCT, largest first
+SCALES = (8, 4, 2)
+MIN_QUALITY = 20 # floor of the JPEG quality of every layer, whatever the rate controller drops
+JPEG_SOI = b'\xff\xd8'
+
+# Delta video: a full JPEG (a refresh) now and then, and in between only the tiles that differ
+# from it. Deltas never build on each other, so a receiver that misses frames, as the relay's
+# frame rate limits make it, still patches a whole picture from the last refresh it got.
+DELTA_VIDEO = True # False sends a full JPEG every frame
+TILE = 32 # pixels, a multiple of the 16 pixel JPEG MCU so no two tiles share a block
+DIFF_STEP = 4 # the change detector compares every DIFF_STEP-th pixel of every DIFF_STEP-th row
+TILE_THRESHOLD = 6.0 # mean difference (0-255, largest channel) that marks a tile as changed
+MAX_CHANGED = 0.5 # fraction of changed tiles above which a refresh is sent instead
+REFRESH_INTERVAL = 5.0 # seconds between refreshes of a layer
+REFRESH_HOLDOFF = 1.0 # requested refreshes closer than this to the last one are ignored, twice the receivers' retry
+DELTA_MARKER = 0x01 # first byte of a delta payload, a JPEG starts with 0xFF
+# delta payload: marker, sequence number of the refresh it patches, tile count,
+# then the index (row major) of each tile, then all the tiles as one JPEG
+DELTA_HEADER = struct.Struct('>BIH')
+TILE_INDEX = np.dtype('>u2')
+
+# All backends take and return BGR frames, as captured by OpenCV and as shown
+# by QImage.Format_BGR888, so no color conversion is needed on either side.
+
+
+def jpeg_size(data) -> tuple[int, int]:
+    # (width, height) from the first SOF marker, None if it cannot be found
+    data = memoryview(data)
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return width, height
+        i += 2 + struct.unpack_from('>H', data, i + 2)[0]
+    return None
+
+
+def pick_scale(size: tuple[int, int], width: int, height: int) -> int:
+    # largest reduction that still gives at least width x height pixels, none without a target size
+    if size is None or not width or not height:
+        return 1
+    for scale in SCALES:
+        if size[0] // scale >= width and size[1] // scale >= height:
+            return scale
+    return 1
+
+
+class OpenCVCodec:
+    name = 'opencv'
+    reduced_flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def encode(self, frame: np.ndarray, quality: int) -> bytes:
+        _, data = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        return data.tobytes()
+
+    def decode(self, data, width: int = 0, height: int = 0) -> np.ndarray:
+        scale = pick_scale(jpeg_size(data), width, height)
+        return cv2.imdecode(np.frombuffer(data, np.uint8), self.reduced_flags[scale])
+
+
+class TurboJPEGCodec:
+    name = 'turbojpeg'
+
+    def __init__(self):
+        if TurboJPEG is None:
+            raise ImportError("PyTurboJPEG is not installed")
+        self.jpeg = TurboJPEG() # raises RuntimeError without libturbojpeg
+
+    def encode(self, frame: np.ndarray, quality: int) -> bytes:
+        return self.jpeg.encode(frame, quality=quality, pixel_format=TJPF_BGR)
+
+    def decode(self, data, width: int = 0, height: int = 0) -> np.ndarray:
+        try:
+            src_width, src_height, _, _ = self.jpeg.decode_header(data)
+            scale = pick_scale((src_width, src_height), width, height)
+            return self.jpeg.decode(data, pixel_format=TJPF_BGR, scaling_factor=(1, scale))
+        except OSError:
+            return None
+
+
+class SimpleJPEGCodec:
+    name = 'simplejpeg'
+
+    def __init__(self):
+        if simplejpeg is None:
+            raise ImportError("simplejpeg is not installed")
+
+    def encode(self, frame: np.ndarray, quality: int) -> bytes:
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=quality, colorspace='BGR')
+
+    def decode(self, data, width: int = 0, height: int = 0) -> np.ndarray:
+        if not width or not height:
+            width, height = jpeg_size(data) or (0, 0) # full size, simplejpeg would reduce as far as it can
+        try:
+            # simplejpeg picks the reduced scale itself from the minimum size
+            return simplejpeg.decode_jpeg(data, colorspace='BGR', min_width=width, min_height=height)
+        except ValueError:
+            return None
+
+
+def get_codec(name: str = None):
+    backends = {codec.name: codec for codec in (TurboJPEGCodec, SimpleJPEGCodec, OpenCVCodec)}
+    for backend in ([name] if name else backends):
+        try:
+            return backends[backend]()
+        except (KeyError, ImportError, RuntimeError, OSError):
+            if name:
+                print(f"[ERROR] JPEG backend {name} not available, using {OpenCVCodec.name}")
+    return OpenCVCodec()
+
+
+codec = get_codec(JPEG_BACKEND)
+
+
+def decode_scaled(data, scale: int) -> np.ndarray:
+    # exactly 1/scale of the picture, decode() picks the largest reduction that is not smaller
+    size = jpeg_size(data)
+    return codec.decode(data, size[0] // scale, size[1] // scale) if size else None
+
+
+def tile_grid(height: int, width: int, tile: int = TILE) -> tuple[int, int]:
+    # rows and columns of tiles covering a frame, the last ones may stick out
+    return -(-height // tile), -(-width // tile)
+
+
+def pad_to_tiles(frame: np.ndarray, tile: int = TILE) -> np.ndarray:
+    rows, cols = tile_grid(*frame.shape[:2], tile)
+    bottom, right = rows * tile - frame.shape[0], cols * tile - frame.shape[1]
+    if not bottom and not right:
+        return frame
+    return cv2.copyMakeBorder(frame, 0, bottom, 0, right, cv2.BORDER_REPLICATE)
+
+
+def tiles_view(padded: np.ndarray, tile: int = TILE) -> np.ndarray:
+    # (rows, cols, tile, tile, 3) view of a padded frame, writes go to the frame
+    rows, cols = tile_grid(*padded.shape[:2], tile)
+    return padded.reshape(rows, tile, cols, tile, -1).swapaxes(1, 2)
+
+
+def make_mosaic(tiles: np.ndarray) -> np.ndarray:
+    # lay n tiles out as a roughly square picture, so they compress as one JPEG
+    count = len(tiles)
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = -(-count // cols)
+    grid = np.zeros((rows * cols,) + tiles.shape[1:], np.uint8)
+    grid[:count] = tiles
+    return grid.reshape(rows, cols, TILE, TILE, -1).swapaxes(1, 2).reshape(rows * TILE, cols * TILE, -1)
+
+
+def split_mosaic(mosaic: np.ndarray, count: int, tile: int = TILE) -> np.ndarray:
+    rows, cols = mosaic.shape[0] // tile, mosaic.shape[1] // tile
+    return mosaic.reshape(rows, tile, cols, tile, -1).swapaxes(1, 2).reshape(rows * cols, tile, tile, -1)[:count]
+
+
+class DeltaEncoder:
+    # one simulcast layer of the sender
+    def __init__(self):
+        self.reference = None # subsampled copy of the last refresh, what deltas are measured against
+        self.refresh_seq = 0
+        self.refreshed = 0.0
+        self.fill = None # (rows, cols) share of each tile inside the frame, edge tiles may stick out
+
+    def reset(self):
+        # the camera stopped, whatever comes next starts with a refresh
+        self.reference = None
+
+    def changed_tiles(self, small: np.ndarray) -> np.ndarray:
+        # indices of the tiles whose mean difference to the reference is above TILE_THRESHOLD;
+        # an exact integer shrink with INTER_AREA is the mean of every tile, in one call
+        height, width = small.shape[:2]
+        rows, cols = self.fill.shape
+        step = TILE // DIFF_STEP
+        diff = cv2.absdiff(small, self.reference)
+        padded = np.zeros((rows * step, cols * step), np.uint8)
+        padded[:height, :width] = cv2.max(cv2.max(diff[..., 0], diff[..., 1]), diff[..., 2])
+        means = cv2.resize(padded, (cols, rows), interpolation=cv2.INTER_AREA)
+        return np.flatnonzero(means > TILE_THRESHOLD * self.fill)
+
+    def set_reference(self, frame: np.ndarray, small: np.ndarray):
+        rows, cols = tile_grid(*frame.shape[:2])
+        step = TILE // DIFF_STEP
+        inside = np.zeros((rows * step, cols * step), np.float32)
+        inside[:small.shape[0], :small.shape[1]] = 1
+        self.fill = cv2.resize(inside, (cols, rows), interpolation=cv2.INTER_AREA)
+        self.reference = small
+
+    def encode(self, frame: np.ndarray, seq: int, quality: int, refresh: bool = False) -> tuple[bytes, bool]:
+        # a delta against the last refresh, or a new refresh: (payload, True for a refresh)
+        if not DELTA_VIDEO:
+            return codec.encode(frame, quality), False
+        now = time.monotonic()
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (-(-width // DIFF_STEP), -(-height // DIFF_STEP)), interpolation=cv2.INTER_NEAREST)
+        if refresh and now - self.refreshed < REFRESH_HOLDOFF:
+            refresh = False
+        if not refresh and self.reference is not None and self.reference.shape == small.shape \
+                and now - self.refreshed < REFRESH_INTERVAL:
+            changed = self.changed_tiles(small)
+            if len(changed) <= MAX_CHANGED * self.fill.size:
+                data = DELTA_HEADER.pack(DELTA_MARKER, self.refresh_seq, len(changed)) + changed.astype(TILE_INDEX).tobytes()
+                if len(changed):
+                    rows, cols = self.fill.shape
+                    tiles = tiles_view(pad_to_tiles(frame))[changed // cols, changed % cols]
+                    data += codec.encode(make_mosaic(tiles), quality)
+                return data, False
+        self.set_reference(frame, small)
+        self.refresh_seq, self.refreshed = seq, now
+        return codec.encode(frame, quality), True
+
+
+class Refresh:
+    # a refresh as received, decoded once for every scale it is shown at
+    def __init__(self, data: bytes):
+        self.data = data
+        self.size = jpeg_size(data)
+        self.pictures = {} # scale -> (picture padded to whole tiles, unpadded height and width)
+        self.lock = threading.Lock() # frames of one sender may render in several decode threads
+
+    def picture(self, scale: int) -> tuple:
+        with self.lock:
+            if scale not in self.pictures:
+                picture = decode_scaled(self.data, scale)
+                if picture is None:
+                    return None, None
+                self.pictures[scale] = pad_to_tiles(picture, TILE // scale), picture.shape[:2]
+            return self.pictures[scale]
+
+
+class DeltaFrame:
+    # the tiles of one delta, patched onto their refresh where the frame is shown: off the
+    # network thread, and at the reduced size the refresh alone would have been decoded at
+    def __init__(self, refresh: Refresh, indices: np.ndarray, mosaic: bytes):
+        self.refresh = refresh
+        self.indices = indices
+        self.mosaic = mosaic # JPEG of the tiles, see make_mosaic
+
+    def render(self, width: int = 0, height: int = 0) -> np.ndarray:
+        # a new BGR frame of at least width x height where the refresh allows, None if a JPEG is corrupt
+        scale = pick_scale(self.refresh.size, width, height)
+        tile = TILE // scale
+        picture, shape = self.refresh.picture(scale)
+        mosaic = decode_scaled(self.mosaic, scale)
+        count = len(self.indices)
+        if picture is None or mosaic is None or mosaic.shape[0] % tile or mosaic.shape[1] % tile \
+                or (mosaic.shape[0] // tile) * (mosaic.shape[1] // tile) < count:
+            return None
+        frame = picture.copy()
+        cols = frame.shape[1] // tile
+        tiles_view(frame, tile)[self.indices // cols, self.indices % cols] = split_mosaic(mosaic, count, tile)
+        return frame[:shape[0], :shape[1]]
+
+
+class DeltaDecoder:
+    # one simulcast layer of one sender, only headers are read here; JPEGs are decoded where
+    # the frame is shown
+    def __init__(self):
+        self.refresh_seq = None
+        self.refresh = None # Refresh of the last one received
+
+    def decode(self, seq: int, data: bytes):
+        # JPEG bytes for a refresh, a DeltaFrame for a delta, None when the refresh it patches never arrived
+        if data[:2] == JPEG_SOI:
+            self.refresh_seq, self.refresh = seq, Refresh(data)
+            return data
+        try:
+            marker, refresh_seq, count = DELTA_HEADER.unpack_from(data)
+        except struct.error:
+            return None
+        if marker != DELTA_MARKER or refresh_seq != self.refresh_seq or self.refresh.size is None:
+            return None
+        if not count:
+            return self.refresh.data # nothing differs from the refresh, whatever earlier deltas showed
+        start = DELTA_HEADER.size + count * TILE_INDEX.itemsize
+        if len(data) < start:
+            return None
+        indices = np.frombuffer(data, TILE_INDEX, count, DELTA_HEADER.size).astype(np.intp)
+        mosaic = data[start:]
+        size = jpeg_size(mosaic)
+        rows, cols = tile_grid(self.refresh.size[1], self.refresh.size[0])
+        if size is None or size[0] % TILE or size[1] % TILE or (size[0] // TILE) * (size[1] // TILE) < count \
+                or indices.max() >= rows * cols:
+            return None
+        return DeltaFrame(self.refresh, indices, mosaic)
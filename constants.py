@@ -1,24 +1,37 @@
 import socket
 import struct
 import pickle
+import time
 from dataclasses import astuple, dataclass
 
 PORT = 53535
 MAIN_PORT = 53530
 VIDEO_PORT = 53531
 AUDIO_PORT = 53532
+FILE_PORT = 53533
+STATS_PORT = 53534 # server stats as JSON over HTTP, localhost only
 # ADDR = ('', PORT)
 DISCONNECT = 'QUIT!'
 OK = 'OK'
-SIZE = 1024
+FILE_CHUNK = 1 << 20 # bytes per sendfile call on the file transfer channel
 
 SERVER = 'SERVER'
+MIX_ID = 0 # sender id of audio mixed by the server, never given to a client
+# the login frame is "name room codecs" (names have no spaces), codecs being the audio codecs
+# the client decodes, comma separated; without a room it joins DEFAULT_ROOM, without codecs it gets PCM
+DEFAULT_ROOM = 'main'
+PEER = 'PEER!' # starts the login frame of a relay linking to another one, see server.py
 
 # requests
 GET = 'GET'
 POST = 'POST'
 ADD = 'ADD'
 RM = 'RM'
+SUBSCRIBE = 'SUB'
+REPORT = 'REPORT'
+SPEAKERS = 'SPEAKERS' # from the server: names of a room's active speakers, loudest first
+REFRESH = 'REFRESH' # video: a full frame the deltas after it patch, and a receiver's request for one
+FEC = 'FEC' # media: parity a receiver rebuilds one lost datagram of a group from, see media.py
 
 # data types
 VIDEO = 'Video'
@@ -26,13 +39,49 @@ AUDIO = 'Audio'
 TEXT = 'Text'
 FILE = 'File'
 
-MEDIA_SIZE = {VIDEO: 25000, AUDIO: 4500}
+# audio: 16-bit mono PCM blocks
+SAMPLE_RATE = 48000
+BLOCK_SIZE = 2048
+# audio codecs, the index is the id audio datagrams carry in their layer byte, see audio_codec.py
+AUDIO_CODECS = ('pcm', 'ulaw', 'adpcm')
+# layer byte of a comfort noise marker, sent instead of blocks while the sender is silent;
+# it has no payload and its level is that of the sender's background noise
+COMFORT_NOISE = 0xFF
+SILENT_LEVEL = 127 # audio level of digital silence, levels are -dBov of the block as in RFC 6464
 
+# largest datagram for each media, video frames are fragmented to stay under the MTU
+MEDIA_SIZE = {VIDEO: 1400, AUDIO: 4500}
 
-def send_bytes(self, msg):
+# simulcast video layers, smallest first: (width, height, jpeg quality)
+VIDEO_LAYERS = ((352, 240, 80), (640, 480, 70), (1080, 720, 70))
+
+# media datagram header: request, data type, sender id, layer (audio codec for audio), audio level,
+# sequence number, fragment index, fragment count, timestamp (ms), payload length
+MEDIA_HEADER = struct.Struct('>BBHBBIHHIH')
+MEDIA_REQUESTS = (ADD, POST, REFRESH, FEC)
+MEDIA_TYPES = (VIDEO, AUDIO)
+
+
+def frame_bytes(msg):
     # Prefix each message with a 4-byte length (network byte order)
-    msg = struct.pack('>I', len(msg)) + msg
-    self.sendall(msg)
+    return struct.pack('>I', len(msg)) + msg
+
+def parse_codecs(text: str) -> tuple[str]:
+    # a comma separated codec list from the other side, unknown names dropped
+    return tuple(name for name in text.split(',') if name in AUDIO_CODECS) or (AUDIO_CODECS[0],)
+
+def unpack_frames(buffer: bytearray):
+    # Pop every complete length-prefixed message from a receive buffer
+    while len(buffer) >= 4:
+        msglen = struct.unpack_from('>I', buffer)[0]
+        if len(buffer) < 4 + msglen:
+            break
+        msg = bytes(buffer[4:4 + msglen])
+        del buffer[:4 + msglen]
+        yield msg
+
+def send_bytes(self, msg):
+    self.sendall(frame_bytes(msg))
 
 def recv_bytes(self):
     # Read message length and unpack it into an integer
@@ -70,6 +119,37 @@ socket.socket.recv_bytes = recv_bytes
 socket.socket.recvall = recvall
 socket.socket.disconnect = disconnect
 
+@dataclass
+class Subscription:
+    # largest frame and frame rate a receiver wants from one sender
+    width: int
+    height: int
+    fps: float
+
+    def layer(self) -> int:
+        # smallest simulcast layer covering the tile, else the largest one
+        for i, (width, height, _) in enumerate(VIDEO_LAYERS):
+            if width >= self.width and height >= self.height:
+                return i
+        return len(VIDEO_LAYERS) - 1
+
+
+@dataclass
+class ReceiverReport:
+    # what a receiver saw of one sender's media over the last report interval
+    loss: float # fraction of video fragments lost
+    delay: float # queuing delay in ms, above the lowest delay seen recently
+    audio_loss: float = 0.0 # fraction of audio blocks lost, both before any recovery from parity
+
+
+@dataclass
+class FileInfo:
+    filename: str
+    size: int
+    digest: str = None # sha256 of the whole file, also its key in the server cache
+    chunk_digests: list = None # sha256 of every FILE_CHUNK, filled in by the server
+
+
 @dataclass
 class Message:
     from_name: str
@@ -77,6 +157,7 @@ class Message:
     data_type: str = None
     data: any = None
     to_names: tuple[str] = None
+    room: str = None # only on file connections, which are not tied to a login
 
     def __str__(self):
         if self.data_type in [VIDEO, AUDIO]:
@@ -90,3 +171,45 @@ class Message:
     
     def __getitem__(self, keys):
         return iter(getattr(self, k) for k in keys)
+
+
+def timestamp_ms():
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+@dataclass
+class MediaPacket:
+    request: str
+    data_type: str
+    sender_id: int
+    seq: int = 0
+    timestamp: int = 0
+    data: bytes = b''
+    layer: int = 0
+    frag: int = 0
+    frag_count: int = 1
+    level: int = SILENT_LEVEL # audio only, 0 is the loudest
+
+    def pack(self) -> bytes:
+        header = MEDIA_HEADER.pack(
+            MEDIA_REQUESTS.index(self.request), MEDIA_TYPES.index(self.data_type),
+            self.sender_id, self.layer, self.level, self.seq, self.frag, self.frag_count, self.timestamp, len(self.data)
+        )
+        return header + self.data
+
+    @classmethod
+    def unpack(cls, buf, header_only: bool = False):
+        # raises struct.error or IndexError for malformed datagrams
+        request, data_type, sender_id, layer, level, seq, frag, frag_count, timestamp, length = MEDIA_HEADER.unpack_from(buf)
+        if header_only:
+            data = b''
+        else:
+            data = memoryview(buf)[MEDIA_HEADER.size:MEDIA_HEADER.size + length]
+        return cls(
+            MEDIA_REQUESTS[request], MEDIA_TYPES[data_type], sender_id, seq, timestamp, data,
+            layer, frag, frag_count, level
+        )
+
+    def __str__(self):
+        return f"[{self.sender_id}] {self.request}:{self.data_type}/{self.layer} #{self.seq} " \
+            f"{self.frag + 1}/{self.frag_count} ({len(self.data)} bytes)"
@@ -0,0 +1,374 @@
+import struct
+import time
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field, replace
+
+from constants import *
+
+REASSEMBLY_TIMEOUT = 0.5 # seconds before an incomplete frame is dropped
+
+
+def seq_newer(a: int, b: int) -> bool:
+    # True if sequence number a comes after b, allowing for 32-bit wraparound
+    return a != b and (a - b) & 0xFFFFFFFF < 0x80000000
+
+
+def fragment(packet: MediaPacket, max_size: int = None) -> list[MediaPacket]:
+    # split a packet so that every datagram, header included, fits in max_size
+    if max_size is None:
+        max_size = MEDIA_SIZE[packet.data_type]
+    chunk = max_size - MEDIA_HEADER.size
+    data = memoryview(packet.data)
+    count = max(1, -(-len(data) // chunk))
+    return [
+        replace(packet, data=data[i * chunk:(i + 1) * chunk], frag=i, frag_count=count)
+        for i in range(count)
+    ]
+
+
+@dataclass
+class PartialFrame:
+    fragments: list
+    received: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+
+class Reassembler:
+    def __init__(self, timeout: float = REASSEMBLY_TIMEOUT):
+        self.timeout = timeout
+        self.frames = {} # (sender id, layer, seq) -> PartialFrame
+        self.last_seq = {} # sender id -> seq of the last frame handed out
+
+    def add(self, packet: MediaPacket) -> MediaPacket:
+        # returns the complete packet once its last fragment arrives, else None
+        last = self.last_seq.get(packet.sender_id, None)
+        if last is not None and not seq_newer(packet.seq, last):
+            return None # a newer frame was already shown
+
+        if packet.frag_count <= 1:
+            self.last_seq[packet.sender_id] = packet.seq
+            return packet
+        if packet.frag >= packet.frag_count:
+            return None
+
+        key = (packet.sender_id, packet.layer, packet.seq)
+        frame = self.frames.get(key, None)
+        if frame is None:
+            self.evict()
+            frame = self.frames[key] = PartialFrame([None] * packet.frag_count)
+        if frame.fragments[packet.frag] is None:
+            frame.fragments[packet.frag] = bytes(packet.data)
+            frame.received += 1
+        if frame.received < len(frame.fragments):
+            return None
+
+        self.frames.pop(key)
+        self.last_seq[packet.sender_id] = packet.seq
+        # frames of this sender older than the completed one can never be shown
+        for old_key in [k for k in self.frames if k[0] == packet.sender_id and not seq_newer(k[2], packet.seq)]:
+            self.frames.pop(old_key)
+        return replace(packet, data=b''.join(frame.fragments), frag=0, frag_count=1)
+
+    def evict(self):
+        now = time.monotonic()
+        for key in [k for k, frame in self.frames.items() if now - frame.started > self.timeout]:
+            self.frames.pop(key)
+
+    def remove(self, sender_id: int):
+        self.last_seq.pop(sender_id, None)
+        for key in [k for k in self.frames if k[0] == sender_id]:
+            self.frames.pop(key)
+
+
+# Rate control
+REPORT_INTERVAL = 1.0 # seconds between receiver reports
+REPORT_TIMEOUT = 3.0 # reports older than this are ignored by the sender
+MIN_BITRATE = 100_000
+START_BITRATE = 2_500_000
+MAX_BITRATE = 8_000_000
+MIN_FPS = 5
+SMOOTH_FPS = 15 # below this, quality and resolution are given up before frame rate
+MAX_FPS = 30
+MAX_QUALITY_DROP = 40 # jpeg quality points removed from every layer at most
+QUALITY_STEP = 10
+LOSS_HIGH, LOSS_LOW = 0.1, 0.02
+RECOVER_INTERVALS = 5 # report intervals in a row of low loss and delay before a layer or quality step comes back
+RECOVER_FPS = 20 # frame rate the bitrate must still allow at the current frame size for a step to come back
+DELAY_HIGH, DELAY_LOW = 150, 50 # ms
+PACING_FACTOR = 1.5 # pace a little above the target so frames do not queue up
+
+
+def signed_delay(now: int, timestamp: int) -> int:
+    # difference of two 32-bit ms timestamps, which may come from different clocks
+    return ((now - timestamp + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+class ReceiveStats:
+    def __init__(self):
+        self.frames = {} # (layer, seq) -> [fragment count, fragments received, first arrival]
+        self.delays = []
+        self.min_delays = deque(maxlen=10) # lowest delay of each recent report
+        self.lost = 0 # fragments never received, over the whole call
+
+    def add(self, packet: MediaPacket):
+        key = (packet.layer, packet.seq)
+        frame = self.frames.get(key, None)
+        if frame is None:
+            frame = self.frames[key] = [packet.frag_count, 0, time.monotonic()]
+        frame[1] += 1
+        self.delays.append(signed_delay(timestamp_ms(), packet.timestamp))
+
+    def report(self) -> ReceiverReport:
+        # frames still inside the reassembly window are left for the next report
+        now = time.monotonic()
+        done = [k for k, frame in self.frames.items() if now - frame[2] > REASSEMBLY_TIMEOUT]
+        expected = received = 0
+        for key in done:
+            count, got, _ = self.frames.pop(key)
+            expected += count
+            received += min(got, count)
+        self.lost += expected - received
+        loss = 1 - received / expected if expected else 0.0
+
+        delay = 0.0
+        if self.delays:
+            self.min_delays.append(min(self.delays))
+            delay = sum(self.delays) / len(self.delays) - min(self.min_delays)
+            self.delays = []
+        return ReceiverReport(loss, delay)
+
+
+class RateController:
+    def __init__(self, max_layers: int = len(VIDEO_LAYERS)):
+        self.bitrate = START_BITRATE
+        self.max_layers = max_layers
+        self.num_layers = max_layers
+        self.quality_drop = 0
+        self.fps = MAX_FPS
+        self.frame_bytes = None # moving average of bytes sent per frame, all layers
+        self.clean = 0 # report intervals in a row with low loss and delay, towards RECOVER_INTERVALS
+        self.reports = {} # receiver name -> (ReceiverReport, time received)
+
+    def on_report(self, receiver: str, report: ReceiverReport):
+        self.reports[receiver] = (report, time.monotonic())
+
+    def on_frame(self, nbytes: int):
+        if self.frame_bytes is None:
+            self.frame_bytes = nbytes
+        else:
+            self.frame_bytes = 0.9 * self.frame_bytes + 0.1 * nbytes
+
+    def fresh_reports(self) -> list[ReceiverReport]:
+        now = time.monotonic()
+        return [report for report, t in self.reports.values() if now - t < REPORT_TIMEOUT]
+
+    def worst_loss(self) -> tuple[float, float]:
+        # (video, audio) loss of the worst receivers, which sets the redundancy of each stream
+        reports = self.fresh_reports()
+        return max((r.loss for r in reports), default=0.0), max((r.audio_loss for r in reports), default=0.0)
+
+    def update(self):
+        # called once per report interval, the worst receiver sets the pace
+        reports = self.fresh_reports()
+        loss = max((report.loss for report in reports), default=0.0)
+        delay = max((report.delay for report in reports), default=0.0)
+        if reports:
+            if loss > LOSS_HIGH or delay > DELAY_HIGH:
+                self.bitrate *= max(0.5, 1 - loss / 2) if loss > LOSS_HIGH else 0.85
+            elif loss < LOSS_LOW and delay < DELAY_LOW:
+                self.bitrate *= 1.08
+            self.bitrate = min(MAX_BITRATE, max(MIN_BITRATE, self.bitrate))
+        self.clean = self.clean + 1 if loss < LOSS_LOW and delay < DELAY_LOW else 0
+
+        if not self.frame_bytes:
+            return
+        fps = self.bitrate / 8 / self.frame_bytes
+        if fps < SMOOTH_FPS:
+            # too little bandwidth for a smooth picture: lower quality, then drop the top layer
+            if self.quality_drop < MAX_QUALITY_DROP:
+                self.quality_drop += QUALITY_STEP
+            elif self.num_layers > 1:
+                self.num_layers -= 1
+            self.clean = 0
+        elif self.clean >= RECOVER_INTERVALS and fps > RECOVER_FPS:
+            # a clean link for a while and room to spare: bring back layers first, then quality,
+            # one step at a time with a fresh run of clean intervals before the next
+            if self.num_layers < self.max_layers:
+                self.num_layers += 1
+            elif self.quality_drop > 0:
+                self.quality_drop -= QUALITY_STEP
+            self.clean = 0
+        self.fps = min(MAX_FPS, max(MIN_FPS, fps))
+
+
+class Pacer:
+    # token bucket spreading datagrams out at a target bitrate
+    def __init__(self, bitrate: float, burst: int = 10 * MEDIA_SIZE[VIDEO]):
+        self.bitrate = bitrate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.bitrate / 8)
+        self.last = now
+
+    def delay(self, nbytes: int) -> float:
+        # spend nbytes now and return how long to wait before sending them,
+        # for callers that cannot block
+        self.refill()
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens * 8 / self.bitrate)
+
+    def wait(self, nbytes: int):
+        time.sleep(self.delay(nbytes))
+
+
+# Forward error correction: a parity datagram is the XOR of a group of datagrams of one
+# stream, from which a receiver rebuilds any one of them that went missing
+FEC_ENABLED = True # add parity to streams whose receivers report loss
+FEC_LOSS = (0.01, 0.04) # reported loss above which a stream gets the next level of redundancy
+FEC_GROUPS = {VIDEO: (0, 10, 5), AUDIO: (0, 4, 2)} # datagrams per parity datagram at each level, 0 for none
+FEC_TIMEOUT = 0.5 # seconds a parity waits for the rest of its group
+FEC_WINDOW = 1024 # datagrams kept to rebuild a lost one from
+# parity payload: fragment count of the frame (1 for audio), first fragment and number of datagrams
+# covered, then the XOR of every covered datagram's FEC_ITEM and payload, zero padded to the longest
+FEC_HEADER = struct.Struct('>HHB')
+FEC_ITEM = struct.Struct('>BBIH') # layer, level, timestamp, payload length
+FEC_OVERHEAD = FEC_HEADER.size + FEC_ITEM.size # bytes a parity datagram carries beyond its longest payload
+VIDEO_FRAGMENT = MEDIA_SIZE[VIDEO] - FEC_OVERHEAD # largest video data datagram, so parity over it fits in MEDIA_SIZE
+
+
+def fec_group(media: str, loss: float) -> int:
+    # datagrams per parity for a stream whose worst receiver lost this much, 0 for no parity
+    if not FEC_ENABLED:
+        return 0
+    level = sum(loss > threshold for threshold in FEC_LOSS)
+    return FEC_GROUPS[media][level]
+
+
+def xor_bytes(items: list) -> bytes:
+    size = max(len(item) for item in items)
+    result = 0
+    for item in items:
+        result ^= int.from_bytes(bytes(item).ljust(size, b'\0'), 'big')
+    return result.to_bytes(size, 'big')
+
+
+def fec_item(packet: MediaPacket) -> bytes:
+    return FEC_ITEM.pack(packet.layer, packet.level, packet.timestamp, len(packet.data)) + bytes(packet.data)
+
+
+def make_parity(packets: list[MediaPacket]) -> MediaPacket:
+    # packets are consecutive fragments of one frame and layer, or consecutive audio blocks
+    first = packets[0]
+    data = FEC_HEADER.pack(first.frag_count, first.frag, len(packets)) + xor_bytes([fec_item(p) for p in packets])
+    return MediaPacket(FEC, first.data_type, first.sender_id, first.seq, first.timestamp, data, first.layer)
+
+
+class VideoParity:
+    # groups never span frames, so the parity reaches exactly the receivers the relay forwards
+    # the frame to; frames smaller than a group get one when the fragments sent since the
+    # last add up to a group, refreshes always get one as the deltas after them depend on them
+    def __init__(self):
+        self.owed = defaultdict(float) # layer -> parity datagrams earned and not yet sent
+
+    def add(self, fragments: list[MediaPacket], group: int, refresh: bool = False) -> list[MediaPacket]:
+        if not group:
+            return []
+        layer = fragments[0].layer
+        owed = self.owed[layer] + len(fragments) / group
+        count = min(len(fragments), max(int(owed), int(refresh)))
+        self.owed[layer] = max(0.0, owed - count)
+        bounds = [len(fragments) * i // count for i in range(count + 1)] if count else []
+        return [make_parity(fragments[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+
+class AudioParity:
+    # one parity per group of consecutive blocks, comfort noise markers and empty blocks included
+    def __init__(self):
+        self.packets = []
+
+    def add(self, packet: MediaPacket, group: int) -> MediaPacket:
+        # the parity this block completes a group for, else None
+        if self.packets and (not group or packet.seq != (self.packets[-1].seq + 1) & 0xFFFFFFFF):
+            self.packets = []
+        if not group:
+            return None
+        self.packets.append(packet)
+        if len(self.packets) < group:
+            return None
+        parity = make_parity(self.packets)
+        self.packets = []
+        return parity
+
+
+class FecDecoder:
+    # rebuilds the one datagram of a group that is missing once everything else, parity
+    # included, has arrived; rebuilt datagrams are POSTs, refreshes among them included
+    def __init__(self):
+        self.received = OrderedDict() # (sender id, media, layer, seq, frag) -> MediaPacket, the last FEC_WINDOW
+        self.pending = [] # (parity, keys it covers, arrival) missing two or more datagrams so far
+
+    def key(self, packet: MediaPacket) -> tuple:
+        if packet.data_type == VIDEO:
+            return (packet.sender_id, VIDEO, packet.layer, packet.seq, packet.frag)
+        return (packet.sender_id, AUDIO, 0, packet.seq, 0)
+
+    def add(self, packet: MediaPacket) -> list[MediaPacket]:
+        # a data datagram, returns any it lets us rebuild
+        key = self.key(packet)
+        if key in self.received:
+            return []
+        self.remember(key, packet)
+        if not self.pending:
+            return []
+        now = time.monotonic()
+        self.pending = [entry for entry in self.pending if now - entry[2] < FEC_TIMEOUT]
+        rebuilt = []
+        for entry in [entry for entry in self.pending if key in entry[1]]:
+            rebuilt += self.recover(entry)
+        return rebuilt
+
+    def add_parity(self, parity: MediaPacket) -> list[MediaPacket]:
+        try:
+            frag_count, first, count = FEC_HEADER.unpack_from(parity.data)
+        except struct.error:
+            return []
+        if parity.data_type == VIDEO:
+            keys = [(parity.sender_id, VIDEO, parity.layer, parity.seq, first + i) for i in range(count)]
+        else:
+            keys = [(parity.sender_id, AUDIO, 0, (parity.seq + i) & 0xFFFFFFFF, 0) for i in range(count)]
+        return self.recover((parity, keys, time.monotonic()))
+
+    def recover(self, entry: tuple) -> list[MediaPacket]:
+        parity, keys, _ = entry
+        missing = [key for key in keys if key not in self.received]
+        if len(missing) > 1:
+            if entry not in self.pending:
+                self.pending.append(entry)
+            return []
+        if entry in self.pending:
+            self.pending.remove(entry)
+        if not missing:
+            return []
+
+        frag_count = FEC_HEADER.unpack_from(parity.data)[0]
+        items = [fec_item(self.received[key]) for key in keys if key != missing[0]]
+        item = xor_bytes(items + [parity.data[FEC_HEADER.size:]])
+        if len(item) < FEC_ITEM.size:
+            return []
+        layer, level, timestamp, length = FEC_ITEM.unpack_from(item)
+        if FEC_ITEM.size + length > len(item):
+            return [] # corrupt, the lengths do not add up
+        sender_id, media, _, seq, frag = missing[0]
+        packet = MediaPacket(POST, media, sender_id, seq, timestamp, item[FEC_ITEM.size:FEC_ITEM.size + length],
+                             layer, frag, frag_count, level)
+        self.remember(missing[0], packet)
+        return [packet]
+
+    def remember(self, key: tuple, packet: MediaPacket):
+        self.received[key] = packet
+        if len(self.received) > FEC_WINDOW:
+            self.received.popitem(last=False)
@@ -1,7 +1,10 @@
 import os
+import time
+import threading
 import cv2
+import numpy as np
 import pyaudio
-from PyQt6.QtCore import Qt, QThread, QTimer, QSize, QRunnable, pyqtSlot
+from PyQt6.QtCore import Qt, QObject, QThreadPool, QTimer, QSize, QRunnable, pyqtSignal, pyqtSlot
 from PyQt6.QtGui import QImage, QPixmap, QActionGroup, QIcon
 from PyQt6.QtWidgets import QMainWindow, QVBoxLayout, QHBoxLayout, QGridLayout, QDockWidget \
     , QLabel, QWidget, QListWidget, QListWidgetItem, QMessageBox \
@@ -9,6 +12,8 @@ from PyQt6.QtWidgets import QMainWindow, QVBoxLayout, QHBoxLayout, QGridLayout,
     , QDialog, QMenu, QWidgetAction, QCheckBox
 
 from constants import *
+from audio import Mixer
+from codec import codec, DeltaFrame
 
 # Camera
 CAMERA_RES = '240p'
@@ -22,12 +27,17 @@ frame_size = {
     '900p': (1400, 900),
     # '1080p': (1920, 1080)
 }
+# max frame rate requested from the server for each layout
+layout_fps = {'240p': 15}
+# the latest active speaker gets a tile of its own at this size, first in the list
+PROMOTE_SPEAKER = True
+SPEAKER_RES = '720p'
 FRAME_WIDTH = frame_size[CAMERA_RES][0]
 FRAME_HEIGHT = frame_size[CAMERA_RES][1]
-
-# Image Encoding
-ENABLE_ENCODE = True
-ENCODE_PARAM = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+CAPTURE_SIZE = VIDEO_LAYERS[-1][:2] # asked of the device, the largest layer; the driver picks its closest mode
+RING_SIZE = 4 # frames the capture thread cycles through, one a reader still holds is replaced rather than reused
+CAPTURE_TIMEOUT = 1.0 # seconds the encoder waits for a frame before sending the camera as off
+CAPTURE_RETRY = 0.1 # seconds between reads while the device gives nothing
 
 # frame for no camera
 NOCAM_FRAME = cv2.imread("img/nocam.jpeg")
@@ -37,11 +47,16 @@ x, y = (nocam_w - FRAME_WIDTH)//2, (nocam_h - FRAME_HEIGHT)//2
 NOCAM_FRAME = NOCAM_FRAME[y:y+FRAME_HEIGHT, x:x+FRAME_WIDTH]
 # frame for no microphone
 NOMIC_FRAME = cv2.imread("img/nomic.jpeg")
+# border of the tiles of active speakers
+SPEAKING_COLOR = (80, 200, 80) # BGR
+SPEAKING_BORDER = 4
+
+# decoding and scaling of received frames, off the GUI thread
+decode_pool = QThreadPool()
+decode_pool.setMaxThreadCount(os.cpu_count() or 1)
 
 # Audio
 ENABLE_AUDIO = True
-SAMPLE_RATE = 48000
-BLOCK_SIZE = 2048
 pa = pyaudio.PyAudio()
 
 
@@ -58,6 +73,23 @@ class Worker(QRunnable):
         self.fn(*self.args, **self.kwargs)
 
 
+class DecodeResults(QObject):
+    # carries decoded images to the GUI thread; it outlives the tiles, which are rebuilt
+    # or removed while the pool may still be decoding for them
+    frame_ready = pyqtSignal(object, QImage) # VideoWidget, image
+
+    def __init__(self):
+        super().__init__()
+        self.frame_ready.connect(self.deliver)
+
+    def deliver(self, video_widget, q_img: QImage):
+        if not video_widget.retired:
+            video_widget.show_frame(q_img)
+
+
+decode_results = DecodeResults()
+
+
 class Microphone:
     def __init__(self):
         self.stream = pa.open(
@@ -72,54 +104,93 @@ class Microphone:
         return self.stream.read(BLOCK_SIZE)
 
 
-class AudioThread(QThread):
-    def __init__(self, client, parent=None):
-        super().__init__(parent)
-        self.client = client
+class AudioPlayer:
+    # single output stream playing the mix of all remote clients,
+    # one block each time the device asks for it
+    def __init__(self, mixer):
+        self.mixer = mixer
         self.stream = pa.open(
             rate=SAMPLE_RATE,
             channels=1,
             format=pyaudio.paInt16,
             output=True,
-            frames_per_buffer=BLOCK_SIZE
+            frames_per_buffer=BLOCK_SIZE,
+            stream_callback=self.update_audio,
+            start=False
         )
-        self.connected = True
 
-    def run(self):
-        # if this is the current client, then don't play audio
-        if self.client.microphone is not None:
-            return
-        while self.connected:
-            self.update_audio()
+    def start(self):
+        self.stream.start_stream()
 
-    def update_audio(self):
-        data = self.client.get_audio()
-        if data is not None:
-            self.stream.write(data)
+    def stop(self):
+        self.stream.stop_stream()
+        self.stream.close()
+
+    def update_audio(self, in_data, frame_count, time_info, status):
+        return self.mixer.mix().tobytes(), pyaudio.paContinue
 
 
 class Camera:
+    # one thread reads the device at its own rate into a ring of reused frames; the encoder
+    # and the self view each take the newest one whenever they are ready, at their own rates,
+    # and hold it untouched until they take the next
     def __init__(self):
         self.cap = cv2.VideoCapture(2)
         if not self.cap.isOpened():
             self.cap = cv2.VideoCapture(0)
-        # self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-        # self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
-
-    def get_frame(self):
-        ret, frame = self.cap.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = cv2.resize(frame, frame_size[CAMERA_RES], interpolation=cv2.INTER_AREA)
-            if ENABLE_ENCODE:
-                _, frame = cv2.imencode('.jpg', frame, ENCODE_PARAM)
-            return frame
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_SIZE[0])
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_SIZE[1])
+        self.ring = [None] * RING_SIZE
+        self.count = 0 # frames captured so far, the newest is in ring[(count - 1) % RING_SIZE]
+        self.held = {} # reader -> number of the frame it took last
+        self.new_frame = threading.Condition()
+        self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.thread.start()
+
+    def capture_loop(self):
+        while self.cap.isOpened():
+            with self.new_frame:
+                slot = self.count % RING_SIZE
+                # decoded into the oldest frame of the ring, no allocation once it is full unless
+                # a reader still holds that frame; readers only ever take the newest, never this one
+                held = self.count + 1 - RING_SIZE in self.held.values()
+                buffer = None if held else self.ring[slot]
+            ret, frame = self.cap.read(buffer)
+            if not ret:
+                time.sleep(CAPTURE_RETRY)
+                continue
+            with self.new_frame:
+                self.ring[slot] = frame
+                self.count += 1
+                self.new_frame.notify_all()
+
+    def latest(self, reader: str) -> tuple[int, np.ndarray]:
+        # (number, BGR frame) of the newest frame, (0, None) before the first one; never blocks
+        with self.new_frame:
+            if not self.count:
+                return 0, None
+            self.held[reader] = self.count
+            return self.count, self.ring[(self.count - 1) % RING_SIZE]
+
+    def next_frame(self, reader: str, after: int) -> tuple[int, np.ndarray]:
+        # blocks for a frame newer than number after, (after, None) if none comes within CAPTURE_TIMEOUT
+        with self.new_frame:
+            if not self.new_frame.wait_for(lambda: self.count > after, CAPTURE_TIMEOUT):
+                return after, None
+            self.held[reader] = self.count
+            return self.count, self.ring[(self.count - 1) % RING_SIZE]
 
 
 class VideoWidget(QWidget):
+    show_stats = False # per-tile stats overlay, toggled from the Stats menu
+
     def __init__(self, client, parent=None):
         super().__init__(parent)
         self.client = client
+        self.tile_size = None # (width, height) of a promoted tile, None follows the layout
+        self.shown_key = None # (frame version, muted, width, height, speaking) last sent for decoding
+        self.decoding = False
+        self.retired = False # replaced or removed from the list, Qt deletes it
         self.init_ui()
 
         self.timer = QTimer()
@@ -145,30 +216,83 @@ class VideoWidget(QWidget):
         self.timer.start(30)
     
     def update_video(self):
-        frame = self.client.get_video()
+        # GUI thread: only hand a frame to the decode pool when something visible changed.
+        # The self view takes the camera's newest frame, as it is, whatever the encoder does,
+        # and not while the pool may still be reading the one it took before.
+        if self.client.current_device and not self.decoding:
+            self.client.get_video()
+        width, height = self.tile_size or (FRAME_WIDTH, FRAME_HEIGHT)
+        key = (self.client.video_version, self.client.is_muted(), width, height, self.client.speaking)
+        if VideoWidget.show_stats:
+            key += (int(time.monotonic()),) # redraw the overlay once a second even on a still frame
+        if self.decoding or key == self.shown_key:
+            return
+        self.decoding = True
+        self.shown_key = key
+        decode_pool.start(Worker(self.decode_frame, self.client.video_frame, *key[1:5]))
+
+    def decode_frame(self, frame, muted: bool, width: int, height: int, speaking: bool):
+        # decode pool thread: decode, scale and overlay, then pass the image to the GUI thread
+        start = time.perf_counter()
+        shared = isinstance(frame, np.ndarray) # the camera's own frame, copied before drawing on it
         if frame is None:
             frame = NOCAM_FRAME.copy()
-        elif ENABLE_ENCODE:
-            frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
-        
-        frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
-        
-        if self.client.audio_data is None:
+        elif not shared:
+            # reduced-size decode when the tile is much smaller than the frame, the tiles of a delta included
+            frame = frame.render(width, height) if isinstance(frame, DeltaFrame) else codec.decode(frame, width, height)
+            if frame is None:
+                decode_results.frame_ready.emit(self, QImage())
+                return
+
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        elif shared:
+            frame = frame.copy()
+
+        if muted:
             # replace bottom center part of the frame with nomic frame
             nomic_h, nomic_w, _ = NOMIC_FRAME.shape
-            x, y = FRAME_WIDTH//2 - nomic_w//2, FRAME_HEIGHT - 50
+            x, y = width//2 - nomic_w//2, height - 50
             frame[y:y+nomic_h, x:x+nomic_w] = NOMIC_FRAME.copy()
 
+        if speaking:
+            cv2.rectangle(frame, (0, 0), (width - 1, height - 1), SPEAKING_COLOR, SPEAKING_BORDER)
+
+        decode_ms = (time.perf_counter() - start) * 1000
+        self.client.decode_ms = 0.9 * self.client.decode_ms + 0.1 * decode_ms
+        if VideoWidget.show_stats:
+            self.draw_stats(frame)
+
         h, w, ch = frame.shape
         bytes_per_line = ch * w
-        q_img = QImage(frame.data, w, h, bytes_per_line, QImage.Format.Format_RGB888)
-        self.video_viewer.setPixmap(QPixmap.fromImage(q_img))
+        q_img = QImage(frame.data, w, h, bytes_per_line, QImage.Format.Format_BGR888)
+        decode_results.frame_ready.emit(self, q_img.copy()) # copy, the numpy frame goes away with this call
+
+    def draw_stats(self, frame):
+        video, audio = self.client.stats[VIDEO], self.client.stats[AUDIO]
+        lines = video.summary() + [
+            f"decode {self.client.decode_ms:.1f} ms queue {video.queue_depth}",
+            f"audio loss {audio.loss_rate() * 100:.1f}% jb {audio.queue_depth}",
+        ]
+        for i, line in enumerate(lines):
+            # dark outline keeps the text readable on any picture
+            org = (8, 20 + 18 * i)
+            cv2.putText(frame, line, org, cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(frame, line, org, cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+
+    def show_frame(self, q_img: QImage):
+        if not q_img.isNull():
+            self.video_viewer.setPixmap(QPixmap.fromImage(q_img))
+        self.decoding = False
 
 
 class VideoListWidget(QListWidget):
+    subscriptions_changed = pyqtSignal(dict)
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.all_items = {}
+        self.promoted = None # name of the remote client shown in the large tile
         self.init_ui()
 
     def init_ui(self):
@@ -176,6 +300,53 @@ class VideoListWidget(QListWidget):
         self.setWrapping(True)
         self.setResizeMode(QListWidget.ResizeMode.Adjust)
         self.setMovement(QListWidget.Movement.Static)
+        self.verticalScrollBar().valueChanged.connect(self.update_subscriptions)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_subscriptions()
+
+    def update_subscriptions(self):
+        # subscribe only to the remote videos currently visible, at the tile size
+        self.executeDelayedItemsLayout()
+        fps = layout_fps.get(LAYOUT_RES, 30)
+        viewport = self.viewport().rect()
+        subscriptions = {}
+        for name, item in self.all_items.items():
+            if self.itemWidget(item).client.current_device:
+                continue
+            if name == self.promoted:
+                subscriptions[name] = Subscription(*frame_size[SPEAKER_RES], layout_fps.get(SPEAKER_RES, 30))
+            elif self.visualItemRect(item).intersects(viewport):
+                subscriptions[name] = Subscription(FRAME_WIDTH, FRAME_HEIGHT, fps)
+        self.subscriptions_changed.emit(subscriptions)
+
+    def promote_speaker(self, names: list):
+        # the loudest remote speaker moves to the front in a large tile, and keeps it for as long as it ranks
+        if not PROMOTE_SPEAKER or self.promoted in names:
+            return
+        name = next((name for name in names if name in self.all_items
+                     and not self.itemWidget(self.all_items[name]).client.current_device), None)
+        if name is None:
+            return
+        previous, self.promoted = self.promoted, name
+        if previous in self.all_items:
+            self.place(previous, self.count() - 1, None)
+        self.place(name, 0, frame_size[SPEAKER_RES])
+        self.update_subscriptions()
+
+    def place(self, name: str, row: int, tile_size: tuple):
+        # a list item cannot move with its widget, the tile is rebuilt at its new row
+        item = self.all_items[name]
+        old_widget = self.itemWidget(item)
+        old_widget.timer.stop()
+        old_widget.retired = True
+        self.takeItem(self.row(item))
+        self.insertItem(row, item)
+        video_widget = VideoWidget(old_widget.client)
+        video_widget.tile_size = tile_size
+        item.setSizeHint(QSize(*(tile_size or (FRAME_WIDTH, FRAME_HEIGHT))))
+        self.setItemWidget(item, video_widget)
 
     def add_client(self, client):
         video_widget = VideoWidget(client)
@@ -191,6 +362,7 @@ class VideoListWidget(QListWidget):
         self.setItemWidget(item, video_widget)
         self.all_items[client.name] = item
         self.resize_widgets()
+        self.update_subscriptions()
     
     def resize_widgets(self, res: str = None):
         global FRAME_WIDTH, FRAME_HEIGHT, LAYOUT_RES
@@ -213,12 +385,20 @@ class VideoListWidget(QListWidget):
             LAYOUT_RES = res
         
         for i in range(n):
-            self.item(i).setSizeHint(QSize(FRAME_WIDTH, FRAME_HEIGHT))
+            tile_size = self.itemWidget(self.item(i)).tile_size
+            self.item(i).setSizeHint(QSize(*(tile_size or (FRAME_WIDTH, FRAME_HEIGHT))))
+        self.update_subscriptions()
 
     def remove_client(self, name: str):
+        video_widget = self.itemWidget(self.all_items[name])
+        video_widget.timer.stop()
+        video_widget.retired = True
         self.takeItem(self.row(self.all_items[name]))
         self.all_items.pop(name)
+        if name == self.promoted:
+            self.promoted = None
         self.resize_widgets()
+        self.update_subscriptions()
 
 
 class ChatWidget(QWidget):
@@ -345,13 +525,22 @@ class LoginDialog(QDialog):
         self.name_edit = QLineEdit(self)
         self.layout.addWidget(self.name_edit, 0, 1)
 
+        self.room_label = QLabel("Room", self)
+        self.layout.addWidget(self.room_label, 1, 0)
+
+        self.room_edit = QLineEdit(DEFAULT_ROOM, self)
+        self.layout.addWidget(self.room_edit, 1, 1)
+
         self.button = QPushButton("Login", self)
-        self.layout.addWidget(self.button, 1, 1)
+        self.layout.addWidget(self.button, 2, 1)
 
         self.button.clicked.connect(self.login)
     
     def get_name(self):
         return self.name_edit.text()
+
+    def get_room(self):
+        return self.room_edit.text().strip() or DEFAULT_ROOM
     
     def login(self):
         if self.get_name() == "":
@@ -370,25 +559,36 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.client = client
         self.server_conn = server_conn
-        self.audio_threads = {}
+        self.mixer = Mixer()
+        self.audio_player = None
 
         self.server_conn.add_client_signal.connect(self.add_client)
         self.server_conn.remove_client_signal.connect(self.remove_client)
         self.server_conn.add_msg_signal.connect(self.add_msg)
+        self.server_conn.file_progress_signal.connect(self.show_file_progress)
+        self.server_conn.connect_failed_signal.connect(self.connect_failed)
 
         self.login_dialog = LoginDialog(self)
         if not self.login_dialog.exec():
             exit()
         
         self.server_conn.name = self.login_dialog.get_name()
+        self.server_conn.room = self.login_dialog.get_room()
         self.server_conn.start()
         self.init_ui()
 
+        if ENABLE_AUDIO:
+            self.mixer.add(SERVER, self.server_conn.mixed_audio)
+            self.audio_player = AudioPlayer(self.mixer)
+            self.audio_player.start()
+
     def init_ui(self):
         self.setWindowTitle("Video Conferencing")
         self.setGeometry(0, 0, 1920, 1000)
 
         self.video_list_widget = VideoListWidget()
+        self.video_list_widget.subscriptions_changed.connect(self.server_conn.send_subscriptions)
+        self.server_conn.speakers_signal.connect(self.video_list_widget.promote_speaker)
         self.setCentralWidget(self.video_list_widget)
 
         self.sidebar = QDockWidget("Chat", self)
@@ -405,6 +605,7 @@ class MainWindow(QMainWindow):
         self.camera_menu = self.menuBar().addMenu("Camera")
         self.microphone_menu = self.menuBar().addMenu("Microphone")
         self.layout_menu = self.menuBar().addMenu("Layout")
+        self.stats_menu = self.menuBar().addMenu("Stats")
         
         self.camera_menu.addAction("Disable", self.toggle_camera)
         self.camera_menu.actions()[0].setIcon(QIcon('img/cam-disable.png'))
@@ -420,24 +621,22 @@ class MainWindow(QMainWindow):
                 layout_action.setChecked(True)
             self.layout_menu.addAction(layout_action)
             self.layout_actions[res] = layout_action
+        stats_action = self.stats_menu.addAction("Show overlay")
+        stats_action.setCheckable(True)
+        stats_action.toggled.connect(lambda checked: setattr(VideoWidget, 'show_stats', checked))
     
     def add_client(self, client):
         self.video_list_widget.add_client(client)
         self.layout_actions[LAYOUT_RES].setChecked(True)
-        if ENABLE_AUDIO:
-            self.audio_threads[client.name] = AudioThread(client, self)
-            self.audio_threads[client.name].start()
+        # the current client's own audio is never played back
         if not client.current_device:
+            self.mixer.add(client.name, client.jitter_buffer)
             self.chat_widget.add_client(client.name)
     
     def remove_client(self, name: str):
         self.video_list_widget.remove_client(name)
         self.layout_actions[LAYOUT_RES].setChecked(True)
-        if ENABLE_AUDIO:
-            self.audio_threads[name].connected = False
-            self.audio_threads[name].wait()
-            self.audio_threads.pop(name)
-            print(f"Audio Thread for {name} terminated")
+        self.mixer.remove(name)
         print(f"removing {name} chat...")
         self.chat_widget.remove_client(name)
         print(f"{name} removed")
@@ -463,18 +662,24 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Error", f"{data_type} cannot be empty")
             return
         
-        msg = Message(self.client.name, POST, data_type, data=msg_text, to_names=selected)
-        self.server_conn.send_msg(self.server_conn.main_socket, msg)
-        
         if data_type == FILE:
-            send_file_thread = Worker(self.server_conn.send_file, filepath, selected)
-            self.server_conn.threadpool.start(send_file_thread)
+            self.server_conn.send_file(filepath, selected)
             msg_text = f"Sending {msg_text}..."
+        else:
+            self.server_conn.send_text(selected, msg_text)
 
         self.chat_widget.add_msg("You", ", ".join(selected), msg_text)
     
     def add_msg(self, from_name: str, msg: str):
         self.chat_widget.add_msg(from_name, "You", msg)
+
+    def connect_failed(self, reason: str):
+        QMessageBox.critical(self, "Error", reason)
+        self.close()
+
+    def show_file_progress(self, filename: str, done: int, total: int):
+        percent = done * 100 // total if total else 100
+        self.statusBar().showMessage(f"{filename}: {percent}%", 3000)
     
     def toggle_camera(self):
         if self.client.camera_enabled:
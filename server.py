@@ -1,163 +1,1443 @@
+import argparse
+import errno
 import socket
-import threading
+import selectors
 import time
 import os
 import traceback
 import pickle
+import struct
+import tempfile
+import shutil
+import hashlib
+import re
+import json
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass, field
+from functools import partial
 
 from constants import *
+from stats import StreamStats
 
 IP = ''
+STATS_IP = '127.0.0.1' # the stats endpoint is only served locally
+MAX_SEND_BUFFER = 4 * 1024 * 1024 # clients falling further behind than this are dropped
+RECV_CHUNK = 65536
+RECV_BATCH = 64 # datagrams drained from a media socket before they are all sent on
+CACHE_DIR = tempfile.mkdtemp(prefix='vc-file-cache-')
+CACHE_LIMIT = 2 << 30 # bytes of uploaded files kept for recipients and re-sends
+MIX_AUDIO = False # mix audio on the server and send every client one stream of everyone else
+LAYER_TIMEOUT = 1.0 # a simulcast layer not seen for this long is treated as dropped by the sender
+SPEAKER_INTERVAL = 0.25 # seconds between active speaker rankings
+SPEAKER_SMOOTHING = 0.5 # weight of the latest interval in a client's speech score
+SPEAKER_LEVEL = 55 # audio level (-dBov) a client's smoothed speech must stay louder than to rank
+PRIORITY_MEMBERS = 5 # rooms this big only forward the video of recent speakers in full, 0 never prioritizes
+SPEAKER_HOLD = 10.0 # seconds a client keeps full video after it last ranked as a speaker
+KEEP_ALIVE_FPS = 1.5 # frame rate of the lowest layer of everyone else, while the receiver is within budget
+VIDEO_BUDGET = 1_000_000 # video bytes per second forwarded to one receiver before keep-alive frames are dropped
+WORKERS = 0 # relay processes rooms are spread over, 0 relays everything in this process
+PORT_STEP = 10 # worker i listens on the media, file and stats ports shifted by PORT_STEP * (i + 1)
+NODE = 0 # number of this relay in a cascade, every linked relay needs its own
+NODE_IDS = 1024 # sender ids handed out by each node, relay n uses n * NODE_IDS + 1 and up
+PEERS = () # (host, main port) of the relays this one links to
+PEER_RETRY = 2.0 # seconds between attempts to reach an unlinked peer
+PEER_TIMEOUT = 1.0 # seconds to wait for a peer to accept the link
+WORKER_MIN_UPTIME = 5.0 # a worker that exits sooner than this after starting is not respawned
 
-clients = {} # list of clients connected to the server
-video_conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-audio_conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-media_conns = {VIDEO: video_conn, AUDIO: audio_conn}
+sel = selectors.DefaultSelector()
+rooms = defaultdict(dict) # room name -> {client name: Client}, a client only sees its own room
+clients_by_id = {} # every client of this process, keyed by the sender id used in media headers
+next_client_id = 1 # within this node's block of ids
+media_conns = {} # media -> UDP socket, opened by the process that relays (forked sockets would be shared)
+mix_seq = 0
+speakers = {} # room -> names of its active speakers as last published, loudest first
+routes_version = 0 # bumped whenever a change could alter where media goes
+blobs = OrderedDict() # file cache, digest -> Blob, least recently used first
+file_buffer = memoryview(bytearray(FILE_CHUNK))
+relay_stats = {VIDEO: StreamStats(), AUDIO: StreamStats()} # all media received, queue depth is the last batch size
+started = time.monotonic()
+port_offset = 0 # PORT_STEP * (i + 1) in worker i
+front_conn = None # pipe to the front process, in workers only
+workers = [] # RelayWorker, in the front process only
+room_workers = {} # room -> index in workers, in the front process only
+# workers must be forked whatever the platform's default start method: they inherit the
+# settings from the command line and the imports of --mix-audio, which are never passed to them
+fork_context = multiprocessing.get_context('fork')
+peers = {} # node -> Peer, relays linked to this one
+peer_nodes = {} # (host, port) in PEERS -> node that answered there
+dialing = {} # (host, port) in PEERS -> (socket, time to give up) of a link waiting for its answer
+next_dial = 0.0
 
-@dataclass
-class Client:
+@dataclass(eq=False) # a connection is only ever equal to itself, peers are kept in sets
+class Connection:
+    # a non-blocking TCP connection carrying framed, pickled messages: a client or a peer relay
     name: str
     main_conn: socket.socket
     connected: bool
-    media_addrs: dict = field(default_factory=lambda: {VIDEO: None, AUDIO: None})
+    id: int
+    recv_buffer: bytearray = field(default_factory=bytearray, kw_only=True)
+    send_buffer: bytearray = field(default_factory=bytearray, kw_only=True)
+    events: int = field(default=selectors.EVENT_READ, kw_only=True)
 
-    def send_msg(self, from_name: str, request: str, data_type: str = None, data: any = None):
-        msg = Message(from_name, request, data_type, data)
+    def send_bytes(self, msg_bytes: bytes):
+        self.send_frame(frame_bytes(msg_bytes))
+
+    def send_frame(self, frame: bytes):
+        # queue an already framed message and write as much as the socket takes right now
+        if not self.connected:
+            return
+        self.send_buffer += frame
+        if len(self.send_buffer) > MAX_SEND_BUFFER:
+            print(f"[{self.name}] [ERROR] Send buffer full, client too slow")
+            self.connected = False
+            return
+        self.flush()
+
+    def flush(self):
         try:
-            if data_type in [VIDEO, AUDIO]:
-                # print(f"[{self.name}] {self.media_addrs}")
-                addr = self.media_addrs.get(data_type, None)
-                if addr is None:
-                    return
-                media_conns[data_type].sendto(pickle.dumps(msg), addr)
-            else:
-                self.main_conn.send_bytes(pickle.dumps(msg))
+            while self.send_buffer:
+                sent = self.main_conn.send(self.send_buffer)
+                del self.send_buffer[:sent]
+        except BlockingIOError:
+            pass
         except (BrokenPipeError, ConnectionResetError, OSError):
             print(f"[{self.name}] [ERROR] BrokenPipeError or ConnectionResetError or OSError")
             self.connected = False
+            return
+
+        events = selectors.EVENT_READ
+        if self.send_buffer:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            sel.modify(self.main_conn, events, self.handle_event)
+
+    def handle_event(self, mask: int):
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ and self.connected:
+            try:
+                data = self.main_conn.recv(RECV_CHUNK)
+            except BlockingIOError:
+                return
+            except (ConnectionResetError, OSError):
+                data = b''
+            if not data:
+                self.connected = False
+                return
+            self.recv_buffer += data
+            self.handle_frames()
+
+    def handle_frames(self):
+        for msg_bytes in unpack_frames(self.recv_buffer):
+            self.handle_msg(msg_bytes)
+            if not self.connected:
+                break
+
+    def handle_msg(self, msg_bytes: bytes):
+        pass # clients and peers each handle their own messages
+
+    def close(self):
+        sel.unregister(self.main_conn)
+        try:
+            self.main_conn.send(self.send_buffer + frame_bytes(pickle.dumps(Message(SERVER, DISCONNECT))))
+        except OSError:
+            pass
+        self.main_conn.close()
+
+
+@dataclass
+class Client(Connection):
+    room: str = DEFAULT_ROOM
+    peer: "Peer" = None # relay the client is connected to, None for this relay's own clients
+    audio_codecs: tuple = (AUDIO_CODECS[0],) # what the client decodes, from its login
+    media_addrs: dict = field(default_factory=lambda: {VIDEO: None, AUDIO: None})
+    subscriptions: dict = None # sender name -> Subscription, None until the client subscribes
+    video_credit: dict = field(default_factory=dict) # sender id -> (frame credit, last update)
+    video_frames: dict = field(default_factory=dict) # sender id -> (seq, forwarded) of the current frame
+    layers_seen: list = field(default_factory=lambda: [0.0] * len(VIDEO_LAYERS)) # last time each layer was sent
+    jitter_buffer: object = None # incoming audio, only when the server mixes
+    audio_encoder: object = None # codec of the mix sent to this client, only when the server mixes
+    fec_decoder: object = None # rebuilds lost audio for the mixer from the client's parity, only when the server mixes
+    mix_parity: object = None # parity of the mix sent to this client, only when the server mixes
+    mix_loss: float = 0.0 # share of the mix the client reported lost, which sets its redundancy
+    audio_peak: int = 0 # loudest speech since the last ranking, in dB above SILENT_LEVEL
+    speech_score: float = 0.0 # audio_peak smoothed over rankings
+    last_spoke: float = float('-inf') # last time the client ranked among its room's speakers
+    video_budget: tuple = None # (byte credit, last update, video bytes sent) towards VIDEO_BUDGET
+    routes: dict = field(default_factory=dict) # (media, layer) -> (route key, [(receiver address, receiver stats)])
+    sent_stats: dict = field(default_factory=lambda: {VIDEO: StreamStats(), AUDIO: StreamStats()}) # media from this client
+    received_stats: dict = field(default_factory=lambda: {VIDEO: StreamStats(), AUDIO: StreamStats()}) # media to this client
+
+    def send_msg(self, from_name: str, request: str, data_type: str = None, data: any = None):
+        msg = Message(from_name, request, data_type, data)
+        if self.peer is not None:
+            # a participant of another relay, reached over the link to it
+            msg.to_names, msg.room = (self.name,), self.room
+            self.peer.send_bytes(pickle.dumps(msg))
+            return
+        self.send_bytes(pickle.dumps(msg))
+
+    def send_media(self, media: str, packet: memoryview):
+        # packet is forwarded as received, header and payload untouched
+        addr = self.media_addrs.get(media, None)
+        if addr is None:
+            return
+        stats = self.received_stats[media]
+        try:
+            media_conns[media].sendto(packet, addr)
+            stats.add(len(packet))
+        except BlockingIOError:
+            stats.lost += 1 # socket buffer full, drop the datagram like the network would
+        except OSError:
+            print(f"[{self.name}] [{media}] [ERROR] OSError")
+
+    def top_layer(self) -> int:
+        # highest simulcast layer this client is currently sending
+        now = time.monotonic()
+        for layer in range(len(self.layers_seen) - 1, 0, -1):
+            if now - self.layers_seen[layer] < LAYER_TIMEOUT:
+                return layer
+        return 0
+
+    def wants_video(self, sender: "Client", header: MediaPacket, top_layer: int, keep_alive: bool) -> bool:
+        # keep_alive: the sender is not a recent speaker of a prioritized room, only its
+        # lowest layer goes out, at KEEP_ALIVE_FPS and within this receiver's video budget
+        layer, fps = top_layer, None
+        if self.subscriptions is not None:
+            sub = self.subscriptions.get(sender.name, None)
+            if sub is None or sub.fps <= 0:
+                return False
+            layer, fps = min(sub.layer(), top_layer), sub.fps
+        if keep_alive:
+            layer, fps = 0, min(fps or KEEP_ALIVE_FPS, KEEP_ALIVE_FPS)
+        if header.layer != layer:
+            return False
+        if fps is None:
+            return True
+        # all fragments of a frame share the decision made on the first one seen
+        seq, forwarded = self.video_frames.get(sender.id, (None, False))
+        if seq == header.seq:
+            return forwarded
+        # a refresh goes out over budget and on credit, the deltas after it are useless without it
+        refresh = header.request == REFRESH
+        forwarded = (refresh or not keep_alive or self.within_video_budget()) and self.take_video_credit(sender, fps, refresh)
+        self.video_frames[sender.id] = (header.seq, forwarded)
+        return forwarded
+
+    def take_video_credit(self, sender: "Client", fps: float, refresh: bool = False) -> bool:
+        # token bucket: earn fps frames per second, spend one per forwarded frame;
+        # a refresh goes out on credit, as the deltas after it cannot be shown without it
+        now = time.monotonic()
+        credit, last = self.video_credit.get(sender.id, (1.0, now))
+        credit = min(1.0, credit + (now - last) * fps)
+        if credit < 1.0 and not refresh:
+            self.video_credit[sender.id] = (credit, now)
+            return False
+        self.video_credit[sender.id] = (max(-1.0, credit - 1.0), now)
+        return True
+
+    def within_video_budget(self) -> bool:
+        # byte bucket over all video sent to this client: earn VIDEO_BUDGET a second, up to a second's worth
+        now = time.monotonic()
+        sent = self.received_stats[VIDEO].bytes
+        credit, last, last_sent = self.video_budget or (VIDEO_BUDGET, now, sent)
+        credit = min(VIDEO_BUDGET, credit + (now - last) * VIDEO_BUDGET - (sent - last_sent))
+        self.video_budget = (credit, now, sent)
+        return credit > 0
+
+    def handle_msg(self, msg_bytes: bytes):
+        handle_main_msg(self, msg_bytes)
+
+
+@dataclass(eq=False)
+class Peer(Connection):
+    # another relay of a cascade, id is its node: membership and messages of the rooms both
+    # relays host go over this link, media of this relay's own clients goes to its media ports
+    media_addrs: dict = None # media -> (host, port)
+    received_stats: dict = field(default_factory=lambda: {VIDEO: StreamStats(), AUDIO: StreamStats()}) # media sent to the peer
+
+    def handle_msg(self, msg_bytes: bytes):
+        handle_peer_msg(self, msg_bytes)
+
+
+def bump_routes():
+    global routes_version
+    routes_version += 1
 
 
-def broadcast_msg(from_name: str, request: str, data_type: str = None, data: any = None):
-    all_clients = tuple(clients.values())
-    for client in all_clients:
-        if client.name == from_name:
+def forward_msg(links, msg: Message):
+    # one copy per peer relay, which hands it on to its own clients
+    frame = frame_bytes(pickle.dumps(msg))
+    for peer in links:
+        peer.send_frame(frame)
+
+
+def broadcast_msg(room: str, from_name: str, request: str, data_type: str = None, data: any = None, forward: bool = True):
+    # pickled and framed once, the same bytes are queued for every client in the room;
+    # every peer gets a copy too, as membership changes must reach relays the room is not on yet
+    frame = frame_bytes(pickle.dumps(Message(from_name, request, data_type, data)))
+    for client in tuple(rooms[room].values()):
+        if client.name == from_name or client.peer is not None:
             continue
-        client.send_msg(from_name, request, data_type, data)
+        client.send_frame(frame)
+    if forward:
+        forward_msg(tuple(peers.values()), Message(from_name, request, data_type, data, room=room))
 
 
-def multicast_msg(from_name: str, request: str, to_names: tuple[str], data_type: str = None, data: any = None):
+def multicast_msg(room: str, from_name: str, request: str, to_names: tuple[str], data_type: str = None, data: any = None,
+                  forward: bool = True):
     if not to_names:
-        broadcast_msg(from_name, request, data_type, data)
+        broadcast_msg(room, from_name, request, data_type, data, forward)
         return
+    frame = frame_bytes(pickle.dumps(Message(from_name, request, data_type, data)))
+    members = rooms[room]
+    links = set()
     for name in to_names:
-        if name not in clients:
+        if name not in members:
             continue
-        clients[name].send_msg(from_name, request, data_type, data)
+        if members[name].peer is not None:
+            links.add(members[name].peer)
+            continue
+        members[name].send_frame(frame)
+    if forward and links:
+        forward_msg(links, Message(from_name, request, data_type, data, to_names, room))
 
 
-def media_server(media: str, port: int):
-    conn = media_conns[media]
-    conn.bind((IP, port))
-    print(f"[LISTENING] {media} Server is listening on {IP}:{port}")
+def media_route(sender: Client, header: MediaPacket) -> list:
+    # receiver addresses and stats for a packet, worked out once per video frame and
+    # once per membership change for audio, then reused for every datagram
+    media = header.data_type
+    key = (routes_version, header.seq) if media == VIDEO else routes_version
+    route = sender.routes.get((media, header.layer), None)
+    if route is not None and route[0] == key:
+        return route[1]
 
-    while True:
-        msg_bytes, addr = conn.recvfrom(MEDIA_SIZE[media])
+    if media == VIDEO:
+        if header.layer < len(sender.layers_seen):
+            sender.layers_seen[header.layer] = time.monotonic()
+        top_layer = sender.top_layer()
+        keep_alive = 0 < PRIORITY_MEMBERS <= len(rooms[sender.room]) and time.monotonic() - sender.last_spoke > SPEAKER_HOLD
+    targets = peer_targets(sender, media)
+    for client in rooms[sender.room].values():
+        addr = client.media_addrs[media]
+        if client is sender or addr is None:
+            continue
+        if media == VIDEO and not client.wants_video(sender, header, top_layer, keep_alive):
+            continue
+        targets.append((addr, client.received_stats[media]))
+    sender.routes[(media, header.layer)] = (key, targets)
+    return targets
+
+
+def peer_targets(sender: Client, media: str) -> list:
+    # peer relays with members in the sender's room get every layer of its media once and pick
+    # layers and frame rates for their own clients; media from a peer is only fanned out here
+    if sender.peer is not None:
+        return []
+    links = {client.peer for client in rooms[sender.room].values() if client.peer is not None}
+    return [(peer.media_addrs[media], peer.received_stats[media]) for peer in links]
+
+
+def handle_media(media: str, bufs: list, mask: int):
+    conn = media_conns[media]
+    # drain up to RECV_BATCH datagrams, then send them all on in one tight loop;
+    # anything left on the socket wakes the selector again straight away
+    batch = []
+    for buf in bufs:
         try:
-            msg: Message = pickle.loads(msg_bytes)
-        except pickle.UnpicklingError:
-            print(f"[{addr}] [{media}] [ERROR] UnpicklingError")
+            nbytes, addr = conn.recvfrom_into(buf)
+        except BlockingIOError:
+            break
+        except OSError:
+            print(f"[{media}] [ERROR] OSError")
+            break
+        packet = memoryview(buf)[:nbytes]
+        try:
+            header = MediaPacket.unpack(packet, header_only=True)
+        except (struct.error, IndexError):
+            print(f"[{addr}] [{media}] [ERROR] Invalid media header")
             continue
 
-        if msg.request == ADD:
-            client = clients[msg.from_name]
+        client = clients_by_id.get(header.sender_id, None)
+        if client is None:
+            continue
+        if header.request == FEC:
+            client.sent_stats[media].add(nbytes)
+            client.sent_stats[media].parity += 1
+        elif header.request != ADD:
+            # loss and reordering from the first fragment of each layer 0 frame,
+            # the one layer every sender always sends, and from every audio block whatever its codec
+            stats = client.sent_stats[media]
+            first = header.frag == 0 and (header.layer == 0 or media == AUDIO)
+            stats.add(nbytes, header.seq if first else None, header.timestamp)
+            if first:
+                stats.frames += 1
+            if media == AUDIO and header.layer != COMFORT_NOISE:
+                client.audio_peak = max(client.audio_peak, SILENT_LEVEL - header.level)
+        if header.request == ADD:
             client.media_addrs[media] = addr
-            print(f"[{addr}] [{media}] {msg.from_name} added")
+            bump_routes()
+            print(f"[{addr}] [{media}] {client.name} added")
+        elif media == AUDIO and MIX_AUDIO:
+            # a copy, the decoder keeps blocks for longer than the receive buffers last
+            audio = MediaPacket.unpack(bytes(packet))
+            if audio.request == FEC:
+                if len(audio.data) >= FEC_HEADER.size:
+                    client.jitter_buffer.protect(FEC_HEADER.unpack_from(audio.data)[2])
+                rebuilt = client.fec_decoder.add_parity(audio)
+            else:
+                client.jitter_buffer.put(audio)
+                rebuilt = client.fec_decoder.add(audio)
+            for block in rebuilt:
+                client.sent_stats[media].recovered += 1
+                client.jitter_buffer.put(block, rebuilt=True)
+            if audio.request != FEC and not audio.data and audio.layer != COMFORT_NOISE:
+                batch.append((packet, media_route(client, header))) # still tell everyone the microphone is off
+            elif client.peer is None:
+                batch.append((packet, peer_targets(client, media))) # peers rebuild and mix for their own clients
         else:
-            broadcast_msg(msg.from_name, msg.request, msg.data_type, msg.data)
+            batch.append((packet, media_route(client, header)))
 
+    relay = relay_stats[media]
+    relay.queue_depth = len(batch)
+    sendto = conn.sendto
+    for packet, targets in batch:
+        nbytes = len(packet)
+        relay.packets += 1
+        relay.bytes += nbytes
+        for addr, stats in targets:
+            try:
+                sendto(packet, addr)
+                stats.packets += 1
+                stats.bytes += nbytes
+            except BlockingIOError:
+                stats.lost += 1 # socket buffer full, drop the datagram like the network would
+            except OSError:
+                print(f"[{addr}] [{media}] [ERROR] OSError")
 
-def disconnect_client(client: Client):
-    global clients
 
-    print(f"[DISCONNECT] {client.name} disconnected from Main Server")
+def mix_audio():
+    # one tick of the server mixer: every client gets everyone's audio in its room but its own,
+    # participants of peer relays are mixed in but get their mix from their own relay
+    global mix_seq
+    timestamp = timestamp_ms()
+    for members in rooms.values():
+        mixing = [client for client in members.values() if client.media_addrs[AUDIO] is not None or client.peer is not None]
+        if len(mixing) < 2:
+            continue
+        mixes = mix_n_minus_one([client.jitter_buffer.get() for client in mixing])
+        for client, mix in zip(mixing, mixes):
+            if client.peer is not None:
+                continue
+            encoder = client.audio_encoder
+            packet = MediaPacket(POST, AUDIO, MIX_ID, mix_seq, timestamp, encoder.encode(mix), AUDIO_CODECS.index(encoder.name))
+            client.send_media(AUDIO, packet.pack())
+            # parity is made per receiver, at the level its own reports ask for
+            parity = client.mix_parity.add(packet, fec_group(AUDIO, client.mix_loss))
+            if parity is not None:
+                client.send_media(AUDIO, parity.pack())
+                client.received_stats[AUDIO].parity += 1
+    mix_seq = (mix_seq + 1) & 0xFFFFFFFF
+
+
+def report_uplinks():
+    # when mixing, the relay is the only receiver of a client's audio, so it reports the loss
+    # of that stream itself, for the client to set its redundancy from
+    for members in rooms.values():
+        for client in members.values():
+            if client.peer is None and client.media_addrs[AUDIO] is not None:
+                client.send_msg(SERVER, REPORT, AUDIO, ReceiverReport(0.0, 0.0, client.sent_stats[AUDIO].interval_loss()))
+
+
+def rank_speakers():
+    # once per SPEAKER_INTERVAL, from the audio levels in the headers: rooms hear about their
+    # active speakers when they change, peers rank their own rooms from the same media
+    threshold = SILENT_LEVEL - SPEAKER_LEVEL
+    now = time.monotonic()
+    for room, members in rooms.items():
+        for client in members.values():
+            client.speech_score += SPEAKER_SMOOTHING * (client.audio_peak - client.speech_score)
+            client.audio_peak = 0
+        ranking = sorted((client for client in members.values() if client.speech_score > threshold),
+                         key=lambda client: client.speech_score, reverse=True)
+        names = [client.name for client in ranking]
+        for client in ranking:
+            client.last_spoke = now
+        if names != speakers.get(room, []):
+            speakers[room] = names
+            broadcast_msg(room, SERVER, SPEAKERS, AUDIO, names, forward=False)
+
+
+@dataclass
+class Blob:
+    # one file in the content-addressed cache, named by its sha256
+    digest: str
+    size: int = 0 # bytes stored so far
+    complete: bool = False
+    chunk_digests: list = field(default_factory=list) # sha256 of every FILE_CHUNK
+    readers: int = 0 # downloads in progress, the blob is not evicted meanwhile
+    uploading: bool = False
+
+    def path(self) -> str:
+        path = os.path.join(CACHE_DIR, self.digest)
+        return path if self.complete else path + '.part'
+
+
+@dataclass
+class Upload:
+    sender: str
+    room: str
+    info: FileInfo
+    to_names: tuple
+    conn: socket.socket
+    blob: Blob
+    file: object
+    hasher: object = field(default_factory=hashlib.sha256)
+    chunk_hasher: object = field(default_factory=hashlib.sha256)
+    chunk_filled: int = 0
+
+    def hash(self, data):
+        # whole-file digest and per-chunk digests, updated as the data arrives
+        view = memoryview(data)
+        while view:
+            n = min(len(view), FILE_CHUNK - self.chunk_filled)
+            self.hasher.update(view[:n])
+            self.chunk_hasher.update(view[:n])
+            self.chunk_filled += n
+            view = view[n:]
+            if self.chunk_filled == FILE_CHUNK:
+                self.end_chunk()
+
+    def end_chunk(self):
+        self.blob.chunk_digests.append(self.chunk_hasher.hexdigest())
+        self.chunk_hasher = hashlib.sha256()
+        self.chunk_filled = 0
+
+
+@dataclass
+class Download:
+    blob: Blob
+    name: str
+    conn: socket.socket
+    file: object
+    offset: int = 0
+
+
+def evict_blobs():
+    # drop least recently used blobs until the cache fits, skipping busy ones
+    total = sum(blob.size for blob in blobs.values())
+    for blob in tuple(blobs.values()):
+        if total <= CACHE_LIMIT:
+            break
+        if blob.readers or blob.uploading:
+            continue
+        os.remove(blob.path())
+        blobs.pop(blob.digest)
+        total -= blob.size
+        print(f"[CACHE] Evicted {blob.digest} ({blob.size} bytes)")
+
+
+def offer_file(upload: Upload):
+    info = upload.info
+    offer = FileInfo(info.filename, info.size, info.digest, upload.blob.chunk_digests)
+    # the blob is only in this relay's cache, so participants of peer relays are not offered it
+    multicast_msg(upload.room, upload.sender, POST, upload.to_names, FILE, offer, forward=False)
+
+
+def send_file_status(conn: socket.socket, status: str):
+    # tiny frames to the uploader, best effort as the socket is non-blocking
+    try:
+        conn.send(frame_bytes(status.encode()))
+    except OSError:
+        pass
+
+
+def close_file_conn(conn: socket.socket, status: str = None):
+    if status is not None:
+        send_file_status(conn, status)
+    sel.unregister(conn)
+    conn.close()
+
+
+def finish_upload(upload: Upload):
+    blob = upload.blob
+    upload.file.close()
+    blob.uploading = False
+    if upload.chunk_filled:
+        upload.end_chunk()
+    if upload.hasher.hexdigest() != blob.digest:
+        print(f"[{upload.sender}] [ERROR] Checksum mismatch for {upload.info.filename}")
+        os.remove(blob.path())
+        blobs.pop(blob.digest)
+        close_file_conn(upload.conn, "Checksum mismatch")
+        return
+    part_path = blob.path()
+    blob.complete = True
+    os.replace(part_path, blob.path())
+    print(f"[{upload.sender}] {upload.info.filename} uploaded ({blob.size} bytes)")
+    close_file_conn(upload.conn, OK)
+    offer_file(upload)
+    evict_blobs()
+
+
+def handle_upload(upload: Upload, mask: int):
+    blob = upload.blob
+    try:
+        n = upload.conn.recv_into(file_buffer, min(FILE_CHUNK, upload.info.size - blob.size))
+    except BlockingIOError:
+        return
+    except OSError:
+        n = 0
+    if not n:
+        # keep the partial blob, the sender can resume from it
+        print(f"[{upload.sender}] [ERROR] Upload of {upload.info.filename} interrupted at {blob.size} bytes")
+        upload.file.close()
+        blob.uploading = False
+        close_file_conn(upload.conn)
+        return
+    data = file_buffer[:n]
+    upload.file.write(data)
+    upload.hash(data)
+    blob.size += n
+    if blob.size >= upload.info.size:
+        finish_upload(upload)
+
+
+def start_upload(conn: socket.socket, msg: Message):
+    info = msg.data
+    room = msg.room or DEFAULT_ROOM
+    if not isinstance(info, FileInfo) or not isinstance(info.digest, str) or not re.fullmatch(r'[0-9a-f]{64}', info.digest) \
+            or type(info.size) is not int or info.size < 0 or not isinstance(room, str) or not isinstance(msg.from_name, str) \
+            or msg.from_name not in rooms.get(room, {}):
+        close_file_conn(conn, "Invalid upload")
+        return
+    to_names = msg.to_names or tuple(name for name in rooms[room] if name != msg.from_name)
+    blob = blobs.get(info.digest, None)
+    if blob is not None and blob.uploading:
+        close_file_conn(conn, "Upload already in progress")
+        return
+    if blob is None or blob.size > info.size:
+        blob = blobs[info.digest] = Blob(info.digest)
+        open(blob.path(), 'wb').close()
+    blobs.move_to_end(info.digest)
+
+    upload = Upload(msg.from_name, room, info, to_names, conn, blob, None)
+    if blob.complete:
+        # already cached: nothing to upload, just offer it again
+        print(f"[{msg.from_name}] {info.filename} served from cache")
+        send_file_status(conn, str(info.size))
+        close_file_conn(conn, OK)
+        offer_file(upload)
+        return
+
+    # resume a partial upload: rebuild the hash state from what is stored
+    blob.chunk_digests = []
+    with open(blob.path(), 'rb') as f:
+        for data in iter(partial(f.read, FILE_CHUNK), b''):
+            upload.hash(data)
+    upload.file = open(blob.path(), 'ab')
+    blob.uploading = True
+    send_file_status(conn, str(blob.size))
+    print(f"[{msg.from_name}] Uploading {info.filename} ({info.size} bytes) from {blob.size} -> {to_names}")
+    sel.modify(conn, selectors.EVENT_READ, partial(handle_upload, upload))
+    if blob.size >= info.size:
+        finish_upload(upload)
+
+
+def finish_download(download: Download):
+    download.blob.readers -= 1
+    download.file.close()
+    sel.unregister(download.conn)
+    download.conn.close()
+
+
+def handle_download(download: Download, mask: int):
+    blob = download.blob
+    try:
+        sent = os.sendfile(download.conn.fileno(), download.file.fileno(), download.offset,
+                           min(blob.size - download.offset, FILE_CHUNK))
+    except BlockingIOError:
+        return
+    except OSError:
+        print(f"[{download.name}] [ERROR] Download of {blob.digest} interrupted at {download.offset} bytes")
+        finish_download(download)
+        return
+    download.offset += sent
+    if download.offset >= blob.size:
+        finish_download(download)
+
+
+def start_download(conn: socket.socket, msg: Message):
+    # msg.data is (digest, offset), the offset lets a receiver resume
+    if not (isinstance(msg.data, tuple) and len(msg.data) == 2 and isinstance(msg.data[0], str)
+            and type(msg.data[1]) is int and msg.data[1] >= 0):
+        print(f"[ERROR] Invalid download request")
+        close_file_conn(conn)
+        return
+    digest, offset = msg.data
+    blob = blobs.get(digest, None)
+    if blob is None or not blob.complete or not 0 <= offset <= blob.size:
+        close_file_conn(conn)
+        return
+    blobs.move_to_end(digest)
+    blob.readers += 1
+    download = Download(blob, msg.from_name, conn, open(blob.path(), 'rb'), offset)
+    sel.modify(conn, selectors.EVENT_WRITE, partial(handle_download, download))
+    if offset == blob.size:
+        finish_download(download)
+
+
+def handle_file_login(conn: socket.socket, buffer: bytearray, mask: int):
+    # the first message on a file connection says whether it uploads or downloads
+    try:
+        data = conn.recv(RECV_CHUNK)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if not data:
+        sel.unregister(conn)
+        conn.close()
+        return
+
+    buffer += data
+    for msg_bytes in unpack_frames(buffer):
+        msg = load_msg(msg_bytes)
+        if msg is not None and msg.request == POST:
+            start_upload(conn, msg)
+        elif msg is not None and msg.request == GET:
+            start_download(conn, msg)
+        else:
+            print(f"[ERROR] Invalid file connection request")
+            close_file_conn(conn)
+        return
+
+
+@dataclass
+class RelayWorker:
+    # a relay process seen from the front process
+    index: int
+    pipe: object
+    process: multiprocessing.Process = None
+    rooms: dict = field(default_factory=dict) # room -> clients handed over and not yet gone
+    started: float = field(default_factory=time.monotonic)
+    alive: bool = True
+
+
+def stats_snapshot() -> dict:
+    if workers:
+        # the front only knows where rooms live, each worker serves its own stats
+        return {
+            'uptime': round(time.monotonic() - started, 1),
+            'workers': [
+                {'pid': worker.process.pid, 'stats_port': STATS_PORT + port_offset + PORT_STEP * (worker.index + 1),
+                 'rooms': worker.rooms, 'alive': worker.alive}
+                for worker in workers
+            ],
+        }
+    return {
+        'uptime': round(time.monotonic() - started, 1),
+        'node': NODE,
+        'relay': {media: stats.snapshot() for media, stats in relay_stats.items()},
+        'peers': {
+            peer.name: {
+                'node': peer.id,
+                'host': peer.media_addrs[VIDEO][0],
+                'send_queue': len(peer.send_buffer),
+                'received': {media: stats.snapshot() for media, stats in peer.received_stats.items()},
+            }
+            for peer in peers.values()
+        },
+        'rooms': {
+            room: {
+                client.name: {
+                    'id': client.id,
+                    'node': client.peer.id if client.peer is not None else NODE,
+                    'send_queue': len(client.send_buffer), # control bytes waiting for the socket
+                    'speech_score': round(client.speech_score, 1),
+                    'full_video': time.monotonic() - client.last_spoke <= SPEAKER_HOLD, # sent in full in prioritized rooms
+                    'sent': {media: stats.snapshot() for media, stats in client.sent_stats.items()},
+                    'received': {media: stats.snapshot() for media, stats in client.received_stats.items()},
+                }
+                for client in members.values()
+            }
+            for room, members in rooms.items()
+        },
+        'file_cache': {'blobs': len(blobs), 'bytes': sum(blob.size for blob in blobs.values())},
+    }
+
+
+def handle_stats(conn: socket.socket, buffer: bytearray, mask: int):
+    # any request on the stats port gets the current snapshot as JSON, then the connection is closed
+    try:
+        data = conn.recv(RECV_CHUNK)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if not data:
+        sel.unregister(conn)
+        conn.close()
+        return
+    body = json.dumps(stats_snapshot(), indent=1).encode()
+    header = f"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    # it grows with the clients: written as fast as the reader takes it, never holding up the relay
+    response = bytearray(header.encode() + body)
+    sel.modify(conn, selectors.EVENT_WRITE, partial(send_stats, conn, response))
+
+
+def send_stats(conn: socket.socket, response: bytearray, mask: int):
+    try:
+        del response[:conn.send(response)]
+    except BlockingIOError:
+        return
+    except OSError:
+        response.clear()
+    if not response:
+        sel.unregister(conn)
+        conn.close()
+
+
+def leave_room(room: str):
+    # tell the front a client it handed over is gone, so empty rooms can move
+    if front_conn is not None:
+        try:
+            front_conn.send(room)
+        except OSError:
+            pass # the front is gone, and this worker is on its way out
+
+
+def disconnect_client(client: Client):
+    # also removes participants of a peer relay, whose own relay tells the other peers
+    print(f"[DISCONNECT] {client.name} disconnected from {client.room}")
     client.media_addrs.update({VIDEO: None, AUDIO: None})
     client.connected = False
 
-    broadcast_msg(client.name, RM)
-    client.main_conn.disconnect()
+    clients_by_id.pop(client.id, None)
+    members = rooms[client.room]
+    for other in members.values():
+        other.video_credit.pop(client.id, None)
+        other.video_frames.pop(client.id, None)
     try:
-        clients.pop(client.name)
+        members.pop(client.name)
     except KeyError:
-        print(f"[ERROR] {client.name} not in clients")
-        print(clients)
-        pass
+        print(f"[ERROR] {client.name} not in {client.room}")
+        print(members)
+    if client.peer is None:
+        client.close()
+    bump_routes()
+    broadcast_msg(client.room, client.name, RM, forward=client.peer is None)
+    if not members:
+        rooms.pop(client.room)
+        speakers.pop(client.room, None)
+    if client.peer is None:
+        leave_room(client.room)
+
+
+def reap_clients():
+    for client in tuple(clients_by_id.values()):
+        if not client.connected:
+            disconnect_client(client)
+    for peer in tuple(peers.values()):
+        if not peer.connected:
+            unlink_peer(peer)
+
+
+def load_msg(msg_bytes: bytes) -> Message:
+    # the unpickled Message, None for anything else; pickle raises far more than UnpicklingError on garbage
+    try:
+        msg = pickle.loads(msg_bytes)
+    except Exception:
+        return None
+    if not isinstance(msg, Message) or not isinstance(msg.to_names, (tuple, list, type(None))):
+        return None
+    return msg
+
+
+def valid_subscriptions(data) -> bool:
+    return data is None or isinstance(data, dict) and all(isinstance(sub, Subscription) for sub in data.values())
+
 
+def handle_main_msg(client: Client, msg_bytes: bytes):
+    msg = load_msg(msg_bytes)
+    if msg is None:
+        print(f"[{client.name}] [ERROR] Invalid message")
+        return
+
+    members = rooms[client.room]
+    if msg.request == REPORT:
+        # pass each report on to the sender it is about, the server's own mix included
+        if not isinstance(msg.data, dict):
+            print(f"[{client.name}] [ERROR] Invalid report")
+            return
+        for sender_name, report in msg.data.items():
+            if not isinstance(report, ReceiverReport):
+                continue
+            if sender_name == SERVER:
+                client.mix_loss = report.audio_loss
+            elif sender_name in members:
+                members[sender_name].send_msg(client.name, REPORT, VIDEO, report)
+        return
+
+    print(msg)
+    if msg.request == DISCONNECT:
+        client.connected = False
+        return
+    if msg.request == SUBSCRIBE:
+        if not valid_subscriptions(msg.data):
+            print(f"[{client.name}] [ERROR] Invalid subscriptions")
+            return
+        client.subscriptions = msg.data
+        bump_routes()
+        return
+    multicast_msg(client.room, client.name, msg.request, msg.to_names, msg.data_type, msg.data)
+
+
+def new_client_id() -> int:
+    # the next free id in this node's block, so ids stay unique across a cascade; None if all are taken
+    global next_client_id
+    for _ in range(NODE_IDS - 1):
+        id = NODE * NODE_IDS + next_client_id
+        next_client_id = next_client_id % (NODE_IDS - 1) + 1
+        if id not in clients_by_id:
+            return id
+    return None
 
-def handle_main_conn(name: str):
-    client: Client = clients[name]
-    conn = client.main_conn
 
-    for client_name in clients:
+def add_client(conn: socket.socket, name: str, room: str, audio_codecs: tuple, id: int) -> Client:
+    client = Client(name, conn, True, id, room, audio_codecs=audio_codecs)
+    relay_codecs = ''
+    if MIX_AUDIO:
+        client.jitter_buffer = JitterBuffer()
+        client.audio_encoder = get_audio_codec(choose_codec(audio_codecs, available_codecs()))
+        client.fec_decoder = FecDecoder()
+        client.mix_parity = AudioParity()
+        relay_codecs = ' ' + ','.join(available_codecs())
+    members = rooms[room]
+    members[name] = client
+    clients_by_id[client.id] = client
+    bump_routes()
+    sel.modify(conn, client.events, client.handle_event)
+    client.send_bytes(OK.encode())
+    client.send_bytes(str(client.id).encode())
+    # this process's media and file ports, which differ from the defaults on workers,
+    # then the audio codecs it decodes if it mixes, as senders must then pick one of those
+    client.send_bytes(f"{VIDEO_PORT + port_offset} {AUDIO_PORT + port_offset} {FILE_PORT + port_offset}{relay_codecs}".encode())
+    print(f"[NEW CONNECTION] {name} connected to {room}")
+
+    for client_name in members:
         if client_name == name:
             continue
-        client.send_msg(client_name, ADD)
-    
-    broadcast_msg(name, ADD)
+        client.send_msg(client_name, ADD, data=(members[client_name].id, members[client_name].audio_codecs))
+    broadcast_msg(room, name, ADD, data=(client.id, audio_codecs))
+    return client
 
-    while client.connected:
-        msg_bytes = conn.recv_bytes()
-        if not msg_bytes:
-            break
+
+def admit(conn: socket.socket, name: str, room: str, audio_codecs: tuple, buffer: bytearray):
+    # conn is registered with sel, buffer holds anything sent after the login
+    id = new_client_id()
+    if name in rooms.get(room, {}) or id is None:
         try:
-            msg = pickle.loads(msg_bytes)
-        except pickle.UnpicklingError:
-            print(f"[{name}] [ERROR] UnpicklingError")
+            conn.send(frame_bytes(("Username already taken" if id is not None else "Relay full").encode()))
+        except OSError:
+            pass
+        sel.unregister(conn)
+        conn.close()
+        leave_room(room)
+        return
+    client = add_client(conn, name, room, audio_codecs, id)
+    client.recv_buffer += buffer
+    client.handle_frames()
+
+
+def peer_login() -> str:
+    # the first frame both ends of a peer link send: marker, node and media ports
+    return f"{PEER} {NODE} {VIDEO_PORT + port_offset} {AUDIO_PORT + port_offset}"
+
+
+def dial_peers():
+    # (re)link every configured peer that has no link, at most once per PEER_RETRY
+    global next_dial
+    if time.monotonic() < next_dial:
+        return
+    next_dial = time.monotonic() + PEER_RETRY
+    for addr, (conn, give_up) in tuple(dialing.items()):
+        if time.monotonic() >= give_up:
+            print(f"[PEER] [ERROR] {addr[0]}:{addr[1]} unreachable: timed out")
+            drop_dial(addr)
+    for addr in PEERS:
+        if peer_nodes.get(addr, None) in peers or addr in dialing:
+            continue
+        # nothing here may block the relay: the connection completes, and the peer login
+        # goes out, when the selector finds the socket writable
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+        error = conn.connect_ex(addr)
+        if error not in (0, errno.EINPROGRESS):
+            print(f"[PEER] [ERROR] {addr[0]}:{addr[1]} unreachable: {os.strerror(error)}")
+            conn.close()
             continue
+        dialing[addr] = conn, time.monotonic() + PEER_TIMEOUT
+        login = bytearray(frame_bytes(peer_login().encode()))
+        sel.register(conn, selectors.EVENT_WRITE, partial(handle_peer_reply, conn, bytearray(), addr, login))
 
-        print(msg)
-        if msg.request == DISCONNECT:
-            break
-        multicast_msg(name, msg.request, msg.to_names, msg.data_type, msg.data)
-    
-    disconnect_client(client)
 
+def drop_dial(addr: tuple):
+    conn, _ = dialing.pop(addr)
+    sel.unregister(conn)
+    conn.close()
+
+
+def handle_peer_reply(conn: socket.socket, buffer: bytearray, addr: tuple, login: bytearray, mask: int):
+    # the dialled relay accepts the connection, takes this relay's peer login (what is left
+    # of it in login) and answers with its own
+    if mask & selectors.EVENT_WRITE:
+        error = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        try:
+            if error:
+                raise OSError(error, os.strerror(error))
+            del login[:conn.send(login)]
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"[PEER] [ERROR] {addr[0]}:{addr[1]} unreachable: {e}")
+            drop_dial(addr)
+            return
+        if not login:
+            sel.modify(conn, selectors.EVENT_READ, partial(handle_peer_reply, conn, buffer, addr, login))
+        return
+    try:
+        data = conn.recv(RECV_CHUNK)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if not data:
+        print(f"[PEER] [ERROR] {addr[0]}:{addr[1]} closed the link")
+        drop_dial(addr)
+        return
+
+    buffer += data
+    for login_bytes in unpack_frames(buffer):
+        dialing.pop(addr)
+        # remembered even when refused, a node linked the other way round is not dialled again
+        # an undecodable login is refused by link_peer like any other invalid one
+        peer_nodes[addr] = link_peer(conn, login_bytes.decode(errors='replace'), buffer)
+        return
+
+
+def link_peer(conn: socket.socket, login: str, buffer: bytearray) -> int:
+    # either end of a new link, once the other end's peer login is in; conn is registered with sel.
+    # Returns the peer's node, None if the login is invalid
+    try:
+        _, node, video_port, audio_port = login.split()
+        node, video_port, audio_port = int(node), int(video_port), int(audio_port)
+    except ValueError:
+        node = None
+    if node is None or node == NODE or node in peers:
+        print(f"[PEER] [ERROR] Refused link from node {node}, invalid or already linked")
+        sel.unregister(conn)
+        conn.close()
+        return node
+    host = conn.getpeername()[0]
+    peer = peers[node] = Peer(f"node{node}", conn, True, node, {VIDEO: (host, video_port), AUDIO: (host, audio_port)})
+    sel.modify(conn, peer.events, peer.handle_event)
+    print(f"[PEER] Linked to node {node} at {host}")
+    # announce this relay's own participants, the peer does the same
+    for client in clients_by_id.values():
+        if client.peer is None:
+            peer.send_bytes(pickle.dumps(Message(client.name, ADD, data=(client.id, client.audio_codecs), room=client.room)))
+    peer.recv_buffer += buffer
+    peer.handle_frames()
+    return node
+
+
+def unlink_peer(peer: Peer):
+    print(f"[PEER] Link to node {peer.id} lost")
+    peers.pop(peer.id)
+    for client in tuple(clients_by_id.values()):
+        if client.peer is peer:
+            disconnect_client(client)
+    peer.close()
+
+
+def add_remote(peer: Peer, name: str, room: str, id: int, audio_codecs: tuple):
+    # a participant that joined a room on a peer relay
+    if name in rooms.get(room, {}) or id in clients_by_id:
+        print(f"[PEER] [ERROR] {name} ({id}) of node {peer.id} clashes with a participant of {room}")
+        return
+    client = Client(name, None, True, id, room, peer, audio_codecs)
+    if MIX_AUDIO:
+        client.jitter_buffer = JitterBuffer()
+        client.fec_decoder = FecDecoder()
+    members = rooms[room]
+    members[name] = client
+    clients_by_id[id] = client
+    bump_routes()
+    print(f"[PEER] {name} joined {room} on node {peer.id}")
+    broadcast_msg(room, name, ADD, data=(id, audio_codecs), forward=False)
+
+
+def valid_remote(msg: Message) -> bool:
+    # a peer's ADD: (sender id, audio codecs) of a participant of one of its rooms
+    if not isinstance(msg.from_name, str) or not isinstance(msg.room, str):
+        return False
+    if not isinstance(msg.data, tuple) or len(msg.data) != 2:
+        return False
+    id, audio_codecs = msg.data
+    return type(id) is int and 0 < id < 1 << 16 and isinstance(audio_codecs, tuple) \
+        and all(name in AUDIO_CODECS for name in audio_codecs)
+
+
+def handle_peer_msg(peer: Peer, msg_bytes: bytes):
+    # relays only pass on their own clients' messages, so nothing here goes to other peers;
+    # a peer sending anything malformed is unlinked, it is not a relay we can trust to follow the protocol
+    msg = load_msg(msg_bytes)
+    if msg is None:
+        print(f"[{peer.name}] [ERROR] Invalid message, unlinking")
+        peer.connected = False
+        return
+
+    if msg.request == DISCONNECT:
+        peer.connected = False
+        return
+    if msg.request == ADD:
+        if not valid_remote(msg):
+            print(f"[{peer.name}] [ERROR] Invalid participant {msg.from_name!r}, unlinking")
+            peer.connected = False
+            return
+        add_remote(peer, msg.from_name, msg.room, *msg.data)
+        return
+    if not isinstance(msg.room, str) or not isinstance(msg.from_name, str):
+        print(f"[{peer.name}] [ERROR] Invalid message, unlinking")
+        peer.connected = False
+        return
+    sender = rooms.get(msg.room, {}).get(msg.from_name, None)
+    if sender is None or sender.peer is not peer:
+        return # gone already, or refused as a clash
+    if msg.request == RM:
+        sender.connected = False
+        return
+    multicast_msg(msg.room, msg.from_name, msg.request, msg.to_names, msg.data_type, msg.data, forward=False)
 
-def main_server():
-    main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    main_socket.bind((IP, MAIN_PORT))
-    main_socket.listen()
-    print(f"[LISTENING] Main Server is listening on {IP}:{MAIN_PORT}")
 
-    video_server_thread = threading.Thread(target=media_server, args=(VIDEO, VIDEO_PORT))
-    video_server_thread.start()
-    audio_server_thread = threading.Thread(target=media_server, args=(AUDIO, AUDIO_PORT))
-    audio_server_thread.start()
+def hand_off(conn: socket.socket, name: str, room: str, audio_codecs: tuple, buffer: bytearray):
+    # front process: every room lives on one worker, new rooms go to the least loaded one
+    index = room_workers.get(room, None)
+    if index is None:
+        live = [i for i in range(len(workers)) if workers[i].alive]
+        if not live:
+            try:
+                conn.send(frame_bytes("Relay full".encode()))
+            except OSError:
+                pass
+            sel.unregister(conn)
+            conn.close()
+            return
+        index = min(live, key=lambda i: sum(workers[i].rooms.values()))
+    worker = workers[index]
+    sel.unregister(conn)
+    try:
+        worker.pipe.send((name, room, audio_codecs, bytes(buffer)))
+        send_handle(worker.pipe, conn.fileno(), worker.process.pid)
+    except OSError as e:
+        print(f"[{name}] [ERROR] Handing over to worker {index} failed: {e}")
+    else:
+        # counted only once the worker has the client, it reports the client leaving
+        room_workers[room] = index
+        worker.rooms[room] = worker.rooms.get(room, 0) + 1
+    conn.close() # the worker holds its own duplicate now
+
+
+def handle_worker_msg(worker: RelayWorker, mask: int):
+    # front process: a client handed to this worker has left its room
+    try:
+        room = worker.pipe.recv()
+    except (EOFError, OSError):
+        worker_exited(worker)
+        return
+    worker.rooms[room] -= 1
+    if not worker.rooms[room]:
+        worker.rooms.pop(room)
+        room_workers.pop(room, None)
+
+
+def worker_exited(worker: RelayWorker):
+    # front process: the worker's clients went with it, its rooms start afresh on whichever worker gets them next
+    sel.unregister(worker.pipe)
+    worker.pipe.close()
+    worker.process.join(1)
+    worker.alive = False
+    for room in worker.rooms:
+        room_workers.pop(room, None)
+    worker.rooms.clear()
+    if time.monotonic() - worker.started < WORKER_MIN_UPTIME:
+        print(f"[ERROR] Worker {worker.index} exited right after starting, its rooms go to the others")
+        return
+    print(f"[ERROR] Worker {worker.index} exited, starting it again")
+    start_worker(worker.index)
+
+
+def handle_front_msg(mask: int):
+    # worker: a logged in connection from the front process
+    try:
+        name, room, audio_codecs, buffer = front_conn.recv()
+        fd = recv_handle(front_conn)
+    except (EOFError, OSError):
+        print(f"[EXITING] Front process is gone")
+        for client in tuple(clients_by_id.values()):
+            disconnect_client(client)
+        os._exit(0)
+    conn = socket.socket(fileno=fd)
+    conn.setblocking(False)
+    sel.register(conn, selectors.EVENT_READ)
+    admit(conn, name, room, audio_codecs, bytearray(buffer))
+
+
+def handle_login(conn: socket.socket, buffer: bytearray, mask: int):
+    try:
+        data = conn.recv(RECV_CHUNK)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if not data:
+        sel.unregister(conn)
+        conn.close()
+        return
+
+    buffer += data
+    for login_bytes in unpack_frames(buffer):
+        try:
+            login = login_bytes.decode()
+        except UnicodeDecodeError:
+            print(f"[ERROR] Invalid login")
+            sel.unregister(conn)
+            conn.close()
+            return
+        if login.startswith(PEER + ' ') and not workers:
+            # another relay linking to this one: answer in kind
+            try:
+                conn.send(frame_bytes(peer_login().encode()))
+            except OSError:
+                pass
+            link_peer(conn, login, buffer)
+            return
+        name, room, audio_codecs = (login.split(' ', 2) + ['', ''])[:3]
+        room = room or DEFAULT_ROOM
+        audio_codecs = parse_codecs(audio_codecs)
+        if workers:
+            hand_off(conn, name, room, audio_codecs, buffer)
+        else:
+            admit(conn, name, room, audio_codecs, buffer)
+        return
+
+
+def accept_conn(listen_socket: socket.socket, handler, mask: int):
+    try:
+        conn, addr = listen_socket.accept()
+    except BlockingIOError:
+        return
+    conn.setblocking(False)
+    sel.register(conn, selectors.EVENT_READ, partial(handler, conn, bytearray()))
+
+
+def listen(ip: str, port: int, handler, what: str) -> socket.socket:
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((ip, port))
+    listen_socket.listen()
+    listen_socket.setblocking(False)
+    sel.register(listen_socket, selectors.EVENT_READ, partial(accept_conn, listen_socket, handler))
+    print(f"[LISTENING] {what} is listening on {ip}:{port}")
+    return listen_socket
+
+
+# handlers that serve one TCP connection each, registered as partials with the connection's state first
+CONN_HANDLERS = (handle_login, handle_file_login, handle_upload, handle_download, handle_peer_reply, handle_stats, send_stats)
+
+
+def drop_failed(key: selectors.SelectorKey):
+    # after a handler raised: close only the connection it was serving, the relay carries on.
+    # Media sockets, listeners and worker pipes are left open, the next datagram or accept is unrelated
+    handler = key.data
+    owner = getattr(handler, '__self__', None)
+    if isinstance(owner, Connection):
+        owner.connected = False # reaped with the other closed connections
+        return
+    if not isinstance(handler, partial) or handler.func not in CONN_HANDLERS:
+        return
+    state = handler.args[0]
+    if isinstance(state, Download):
+        finish_download(state)
+        return
+    if isinstance(state, Upload):
+        state.file.close()
+        state.blob.uploading = False
+    if handler.func is handle_peer_reply:
+        dialing.pop(handler.args[2], None)
+    conn = key.fileobj
+    if sel.get_map().get(conn, None) is not None:
+        sel.unregister(conn)
+    conn.close()
+
+
+def dispatch(key: selectors.SelectorKey, mask: int):
+    try:
+        key.data(mask)
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        print(traceback.format_exc())
+        drop_failed(key)
 
+
+def serve_relay():
+    # file, stats and media sockets of this relay process, then its event loop
+    listen(IP, FILE_PORT + port_offset, handle_file_login, "File Server")
+    listen(STATS_IP, STATS_PORT + port_offset, handle_stats, "Stats Server")
+    for media, port in ((VIDEO, VIDEO_PORT), (AUDIO, AUDIO_PORT)):
+        conn = media_conns[media] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        conn.bind((IP, port + port_offset))
+        conn.setblocking(False)
+        bufs = [bytearray(MEDIA_SIZE[media]) for _ in range(RECV_BATCH)]
+        sel.register(conn, selectors.EVENT_READ, partial(handle_media, media, bufs))
+        print(f"[LISTENING] {media} Server is listening on {IP}:{port + port_offset}")
+
+    next_mix = next_ranking = next_report = time.monotonic()
     while True:
-        conn, addr = main_socket.accept()
-        name = conn.recv_bytes().decode()
-        if name in clients:
-            conn.send_bytes("Username already taken".encode())
-            continue
-        conn.send_bytes(OK.encode())
-        clients[name] = Client(name, conn, True)
-        print(f"[NEW CONNECTION] {name} connected to Main Server")
+        deadline = next_ranking
+        if MIX_AUDIO:
+            deadline = min(deadline, next_mix, next_report)
+        if PEERS:
+            dial_peers()
+            deadline = min(deadline, time.monotonic() + PEER_RETRY)
+        for key, mask in sel.select(max(0, deadline - time.monotonic())):
+            dispatch(key, mask)
+        reap_clients()
+
+        if time.monotonic() >= next_ranking:
+            rank_speakers()
+            next_ranking = time.monotonic() + SPEAKER_INTERVAL
+
+        if MIX_AUDIO and time.monotonic() >= next_mix:
+            mix_audio()
+            # one block per tick, catching up after a stall without bursting forever
+            next_mix = max(next_mix + BLOCK_MS / 1000, time.monotonic() - BLOCK_MS / 1000)
+
+        if MIX_AUDIO and time.monotonic() >= next_report:
+            report_uplinks()
+            next_report = time.monotonic() + REPORT_INTERVAL
+
+
+def run_worker(index: int, pipe, cache_dir: str):
+    global sel, front_conn, port_offset, CACHE_DIR
+    # a forked worker must not share the front's epoll instance, nor think it is the front
+    for key in tuple(sel.get_map().values()):
+        key.fileobj.close() # listeners and logins of the front, when a worker is started again
+    sel.close()
+    sel = selectors.DefaultSelector()
+    for worker in workers:
+        worker.pipe.close() # front ends of the pipes, or a worker would never see the front exit
+    workers.clear()
+    room_workers.clear()
+    front_conn = pipe
+    port_offset += PORT_STEP * (index + 1)
+    CACHE_DIR = cache_dir
+    sel.register(pipe, selectors.EVENT_READ, handle_front_msg)
+    try:
+        serve_relay()
+    except KeyboardInterrupt:
+        for client in tuple(clients_by_id.values()):
+            disconnect_client(client)
+    except Exception as e:
+        print(f"[ERROR] Worker {index}: {e}")
+        print(traceback.format_exc())
+    finally:
+        os._exit(0)
+
+
+def start_worker(index: int):
+    # front process: fork relay process index, in place of a previous one that exited
+    front_pipe, worker_pipe = fork_context.Pipe()
+    cache_dir = os.path.join(CACHE_DIR, f'worker{index}')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    worker = RelayWorker(index, front_pipe)
+    if index < len(workers):
+        workers[index] = worker
+    else:
+        workers.append(worker)
+    worker.process = fork_context.Process(target=run_worker, args=(index, worker_pipe, cache_dir), daemon=True)
+    worker.process.start()
+    worker_pipe.close()
+    sel.register(front_pipe, selectors.EVENT_READ, partial(handle_worker_msg, worker))
 
-        main_conn_thread = threading.Thread(target=handle_main_conn, args=(name,))
-        main_conn_thread.start()
+
+def main_server():
+    # workers start before the front binds anything, so they do not inherit its listeners
+    for index in range(WORKERS):
+        start_worker(index)
+
+    listen(IP, MAIN_PORT + port_offset, handle_login, "Main Server")
+    if not workers:
+        serve_relay()
+        return
+    listen(STATS_IP, STATS_PORT + port_offset, handle_stats, "Stats Server")
+    print(f"[LISTENING] Rooms are relayed by {len(workers)} workers")
+    while True:
+        for key, mask in sel.select():
+            dispatch(key, mask)
+
+
+def peer_address(value: str) -> tuple:
+    # resolved once here, a name lookup while dialling would block the relay
+    host, _, port = value.rpartition(':')
+    try:
+        return socket.gethostbyname(host or 'localhost'), int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value}")
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"cannot resolve {host}: {e}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Video conferencing relay")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="relay processes rooms are spread over")
+    parser.add_argument('--node', type=int, default=NODE, help="number of this relay in a cascade, unique among linked relays")
+    parser.add_argument('--offset', type=int, default=0, help="added to every port, to run several relays on one host")
+    parser.add_argument('--peer', type=peer_address, action='append', default=[], metavar='HOST:PORT',
+                        help="main port of another relay of the cascade to link to, repeatable")
+    parser.add_argument('--priority-members', type=int, default=PRIORITY_MEMBERS,
+                        help="rooms this big only forward full video of recent speakers, 0 treats everyone alike")
+    parser.add_argument('--mix-audio', action=argparse.BooleanOptionalAction, default=MIX_AUDIO,
+                        help="mix audio on the relay and send every client one stream of everyone else")
+    args = parser.parse_args()
+    if args.peer and args.workers:
+        parser.error("--peer needs a single process relay, without --workers")
+    if not 0 <= args.node < 0x10000 // NODE_IDS:
+        parser.error(f"--node must be below {0x10000 // NODE_IDS}, sender ids are 16 bits")
+    WORKERS, NODE, port_offset, PEERS = args.workers, args.node, args.offset, tuple(args.peer)
+    PRIORITY_MEMBERS, MIX_AUDIO = args.priority_members, args.mix_audio
+    if MIX_AUDIO:
+        # only a mixing relay decodes audio, and needs numpy and the codecs; forked workers inherit these
+        from audio import JitterBuffer, mix_n_minus_one, BLOCK_MS
+        from audio_codec import available_codecs, choose_codec, get_audio_codec
+        from media import FecDecoder, AudioParity, fec_group, FEC_HEADER, REPORT_INTERVAL
     try:
         main_server()
     except KeyboardInterrupt:
         print(traceback.format_exc())
         print(f"[EXITING] Keyboard Interrupt")
-        for client in clients.values():
+        for client in tuple(clients_by_id.values()):
             disconnect_client(client)
     except Exception as e:
         print(f"[ERROR] {e}")
         print(traceback.format_exc())
     finally:
-        os._exit(0)
\ No newline at end of file
+        for worker in workers:
+            worker.process.join(1)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        os._exit(0)
@@ -0,0 +1,126 @@
+import bisect
+import time
+
+from constants import *
+from media import seq_newer, signed_delay
+
+LATENCY_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000) # ms, upper bounds, one more bucket above the last
+RATE_WINDOW = 1.0 # seconds over which fps, packet rate and bitrate are measured
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p: float) -> float:
+        # upper bound of the bucket holding the p-th percentile, inf for the overflow bucket
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= p / 100 * self.count:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 1) if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['inf'], self.counts)),
+        }
+
+
+class StreamStats:
+    # counters for one stream: what one client sends, or what one client is sent
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.lost = 0
+        self.reordered = 0
+        self.parity = 0 # parity datagrams among packets
+        self.recovered = 0 # datagrams rebuilt from parity, not among packets
+        self.loss_mark = (0, 0) # lost and received at the last interval_loss
+        self.last_seq = None
+        self.latency = Histogram() # one-way ms, includes any clock offset between hosts
+        self.queue_depth = 0
+        self.window = [time.monotonic(), 0, 0, 0] # start, packets, bytes, frames at the start
+        self.fps = self.pps = self.bitrate = 0.0
+
+    def add(self, nbytes: int, seq: int = None, timestamp: int = None):
+        # seq only for packets of a gapless sequence (audio blocks, first video fragments)
+        self.packets += 1
+        self.bytes += nbytes
+        if timestamp is not None:
+            self.latency.add(signed_delay(timestamp_ms(), timestamp))
+        if seq is None:
+            return
+        if self.last_seq is None or seq_newer(seq, self.last_seq):
+            if self.last_seq is not None:
+                self.lost += (seq - self.last_seq - 1) & 0xFFFFFFFF
+            self.last_seq = seq
+        elif seq != self.last_seq:
+            # late rather than lost after all
+            self.reordered += 1
+            self.lost = max(0, self.lost - 1)
+
+    def update_rates(self):
+        now = time.monotonic()
+        start, packets, nbytes, frames = self.window
+        elapsed = now - start
+        if elapsed < RATE_WINDOW:
+            return
+        self.pps = (self.packets - packets) / elapsed
+        self.bitrate = (self.bytes - nbytes) * 8 / elapsed
+        self.fps = (self.frames - frames) / elapsed
+        self.window = [now, self.packets, self.bytes, self.frames]
+
+    def loss_rate(self) -> float:
+        expected = self.packets - self.parity + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def interval_loss(self) -> float:
+        # loss since the last call, before any recovery from parity
+        lost, received = self.lost, self.packets - self.parity
+        lost_before, received_before = self.loss_mark
+        self.loss_mark = (lost, received)
+        lost, received = max(0, lost - lost_before), received - received_before
+        return lost / (lost + received) if lost + received > 0 else 0.0
+
+    def snapshot(self) -> dict:
+        self.update_rates()
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'lost': self.lost,
+            'loss_rate': round(self.loss_rate(), 4),
+            'reordered': self.reordered,
+            'parity': self.parity,
+            'recovered': self.recovered,
+            'fps': round(self.fps, 1),
+            'pps': round(self.pps, 1),
+            'kbps': round(self.bitrate / 1000, 1),
+            'queue_depth': self.queue_depth,
+            'latency_ms': self.latency.snapshot(),
+        }
+
+    def summary(self) -> list[str]:
+        # short lines for the video overlay
+        self.update_rates()
+        return [
+            f"{self.fps:.0f} fps {self.bitrate / 1000:.0f} kbps",
+            f"loss {self.loss_rate() * 100:.1f}% fec {self.recovered} reord {self.reordered}",
+            f"lat p50 {self.latency.percentile(50):g} p95 {self.latency.percentile(95):g} ms",
+        ]
@@ -0,0 +1,69 @@
+import numpy as np
+
+from codec import codec, pick_scale, DeltaEncoder, DeltaDecoder, DeltaFrame
+
+
+def make_frame(height: int = 240, width: int = 352) -> np.ndarray:
+    # a smooth picture that compresses without much error
+    x = np.linspace(60, 190, width, dtype=np.float32)
+    y = np.linspace(-20, 20, height, dtype=np.float32)[:, None]
+    gray = (x + y).astype(np.uint8)
+    return np.dstack([gray, gray, 255 - gray])
+
+
+def show(frame, width: int = 352, height: int = 240) -> np.ndarray:
+    # what a tile of the frame's own size shows
+    if isinstance(frame, DeltaFrame):
+        return frame.render(width, height)
+    return codec.decode(frame, width, height)
+
+
+def region_error(shown: np.ndarray, expected: np.ndarray) -> float:
+    return float(np.abs(shown[64:128, 96:160].astype(np.int16) - expected[64:128, 96:160]).mean())
+
+
+def test_refresh_change_revert():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    base = make_frame()
+    changed = base.copy()
+    changed[64:128, 96:160] = 255
+
+    data, refresh = encoder.encode(base, 1, 90)
+    assert refresh
+    assert region_error(show(decoder.decode(1, data)), base) < 4
+
+    data, refresh = encoder.encode(changed, 2, 90)
+    assert not refresh
+    frame = decoder.decode(2, data)
+    assert isinstance(frame, DeltaFrame)
+    assert region_error(show(frame), changed) < 4
+
+    # back to the refresh picture: no tiles differ, and the change must not stay on screen
+    data, refresh = encoder.encode(base, 3, 90)
+    assert not refresh
+    assert region_error(show(decoder.decode(3, data)), base) < 4
+
+
+def test_delta_without_refresh():
+    encoder, decoder = DeltaEncoder(), DeltaDecoder()
+    base = make_frame()
+    encoder.encode(base, 1, 90)
+    changed = base.copy()
+    changed[:32, :32] = 0
+    data, _ = encoder.encode(changed, 2, 90)
+    assert decoder.decode(2, data) is None
+
+
+def test_decode_without_size_is_full_size():
+    frame = make_frame()
+    data = codec.encode(frame, 90)
+    assert codec.decode(data).shape == frame.shape
+    assert codec.decode(data, 0, 0).shape == frame.shape
+    assert codec.decode(data, 88, 60).shape == (60, 88, 3)
+
+
+def test_pick_scale():
+    assert pick_scale((1280, 720), 0, 0) == 1
+    assert pick_scale((1280, 720), 320, 180) == 4
+    assert pick_scale((1280, 720), 321, 180) == 2
+    assert pick_scale(None, 320, 180) == 1